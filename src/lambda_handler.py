@@ -1,37 +1,111 @@
+from __future__ import annotations
+
+import hashlib
+import heapq
+import itertools
 import json
+import logging
 import os
+import random
+import re
+import threading
+import time
 import uuid
+import zlib
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Optional
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Optional, Union
+
+if TYPE_CHECKING:
+    import requests
+    from sgqlc.endpoint.http import HTTPEndpoint
+
+# boto3, requests and sgqlc are imported where they are first used, and the sgqlc schema classes are
+# built on first use, to keep them out of the cold start. IMPORT_TIME_BUDGET_MS in the tests guards this.
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_SHARD_MAX_BYTES = 64 * 1024 * 1024
+
+SCHEMA_TYPES = (
+    "FileMetadata", "File", "FileMetadataFilters", "FileFilters", "PaginationInput",
+    "FileEdge", "FileConnection", "Consignment", "Query"
+)
+_schema_lock = threading.Lock()
+_schema = None
+
+
+def get_schema() -> SimpleNamespace:
+    """Builds the sgqlc schema classes the first time they are needed."""
+    global _schema
+    with _schema_lock:
+        if _schema is None:
+            from sgqlc.types import Input, Type, Field, list_of
+            from sgqlc.types.relay import Connection
 
-import requests
-from boto3 import resource, client
-from sgqlc.endpoint.http import HTTPEndpoint
-from sgqlc.operation import Operation
-from sgqlc.types import Type, Field, list_of
-from sgqlc.types.relay import Connection
+            class FileMetadata(Type):
+                name = Field(str)
+                value = Field(str)
 
+            class File(Type):
+                fileId = Field(str)
+                uploadMatchId = Field(str)
+                fileType = Field(str)
+                fileMetadata = list_of(FileMetadata)
 
-class FileMetadata(Type):
-    name = Field(str)
-    value = Field(str)
+            class FileMetadataFilters(Input):
+                properties = list_of(str)
 
+            class FileFilters(Input):
+                fileTypeIdentifier = Field(str)
+                metadataFilters = Field(FileMetadataFilters)
 
-class File(Type):
-    fileId = Field(str)
-    uploadMatchId = Field(str)
-    fileType = Field(str)
-    fileMetadata = list_of(FileMetadata)
+            class PaginationInput(Input):
+                limit = Field(int)
+                currentCursor = Field(str)
+                fileFilters = Field(FileFilters)
 
+            class FileEdge(Type):
+                node = Field(File)
+                cursor = Field(str)
 
-class Consignment(Connection):
-    files = list_of(File)
-    consignmentType = Field(str)
-    userid = Field(str)
+            class FileConnection(Connection):
+                edges = list_of(FileEdge)
 
+            class Consignment(Connection):
+                files = Field(list_of(File), args={'fileFiltersInput': FileFilters})
+                paginatedFiles = Field(FileConnection, args={'paginationInput': PaginationInput})
+                consignmentType = Field(str)
+                userid = Field(str)
 
-class Query(Type):
-    getConsignment = Field(Consignment, args={'consignmentid': str})
+            class Query(Type):
+                getConsignment = Field(Consignment, args={'consignmentid': str})
+
+            _schema = SimpleNamespace(
+                FileMetadata=FileMetadata,
+                File=File,
+                FileMetadataFilters=FileMetadataFilters,
+                FileFilters=FileFilters,
+                PaginationInput=PaginationInput,
+                FileEdge=FileEdge,
+                FileConnection=FileConnection,
+                Consignment=Consignment,
+                Query=Query
+            )
+        return _schema
+
+
+def __getattr__(name):
+    if name in SCHEMA_TYPES:
+        return getattr(get_schema(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 @dataclass(frozen=True)
@@ -41,9 +115,286 @@ class BuildSettings:
     s3_source_bucket_prefix: Optional[str] = None
 
 
+class StageTimer:
+    """Times the stages of an invocation, including how long was saved by running some of them in the background."""
+
+    def __init__(self):
+        self.stages = {}
+        self._started = time.perf_counter()
+
+    def run(self, stage, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.stages[stage] = {"seconds": time.perf_counter() - start}
+
+    def submit(self, executor: ThreadPoolExecutor, stage, func, *args) -> Future:
+        return executor.submit(self.run, stage, func, *args)
+
+    def result(self, stage, future: Future):
+        start = time.perf_counter()
+        try:
+            return future.result()
+        finally:
+            waited = time.perf_counter() - start
+            timings = self.stages.setdefault(stage, {"seconds": waited})
+            timings["waitedSeconds"] = waited
+            timings["savedSeconds"] = max(timings["seconds"] - waited, 0)
+
+    def record(self, metrics: "Metrics"):
+        for stage, timings in self.stages.items():
+            metrics.add_duration(stage, timings["seconds"])
+        saved_seconds = sum(timings.get("savedSeconds", 0) for timings in self.stages.values())
+        metrics.add_duration("concurrencySaved", saved_seconds)
+
+    def log(self, consignment_id):
+        wall_clock = time.perf_counter() - self._started
+        sequential = sum(timings["seconds"] for timings in self.stages.values())
+        logger.info(json.dumps({
+            "consignmentId": consignment_id,
+            "stages": self.stages,
+            "sequentialSeconds": sequential,
+            "wallClockSeconds": wall_clock,
+            "savedSeconds": sum(timings.get("savedSeconds", 0) for timings in self.stages.values())
+        }))
+
+
+METRICS_NAMESPACE = "TDRFileUploadData"
+METRIC_UNITS = {"responseBytes": "Bytes", "resultBytes": "Bytes"}
+
+_active_metrics = threading.local()
+
+
+class Metrics:
+    """Collects an invocation's stage durations and counters and prints them as a CloudWatch EMF line."""
+
+    def __init__(self, consignment_id=None):
+        self.consignment_id = consignment_id
+        self.durations = {}
+        self.counters = {}
+        self.level = os.environ.get("METRICS_LEVEL", "stages")
+        self.sampled = random.random() < float(os.environ.get("METRICS_SAMPLE_RATE", 1))
+
+    @contextmanager
+    def activate(self):
+        """Makes these the metrics returned by current_metrics on this thread."""
+        previous = getattr(_active_metrics, "metrics", None)
+        _active_metrics.metrics = self
+        try:
+            yield self
+        finally:
+            _active_metrics.metrics = previous
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_duration(stage, time.perf_counter() - start)
+
+    def add_duration(self, stage, seconds):
+        self.durations[stage] = self.durations.get(stage, 0) + seconds * 1000
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_emf(self):
+        values = dict(self.counters)
+        definitions = [{"Name": name, "Unit": METRIC_UNITS.get(name, "Count")} for name in self.counters]
+        if self.level == "stages":
+            for stage, milliseconds in self.durations.items():
+                values[f"{stage}Duration"] = milliseconds
+                definitions.append({"Name": f"{stage}Duration", "Unit": "Milliseconds"})
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["FunctionName"]],
+                    "Metrics": definitions
+                }]
+            },
+            "FunctionName": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "file-upload-data"),
+            "consignmentId": self.consignment_id
+        } | values
+
+    def emit(self):
+        if self.sampled and self.level != "none":
+            print(json.dumps(self.to_emf()), flush=True)
+
+
+def current_metrics() -> Metrics:
+    """Returns the metrics of the invocation running on this thread, or a throwaway instance outside one."""
+    return getattr(_active_metrics, "metrics", None) or Metrics()
+
+
+def counted(items: Iterable, name) -> Iterator:
+    metrics = current_metrics()
+    for item in items:
+        metrics.count(name)
+        yield item
+
+
+class _MeteredResponse:
+    """Wraps a urlopen response to count the bytes read from it."""
+
+    def __init__(self, response):
+        self._response = response
+        self.headers = response.headers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._response.close()
+
+    def read(self, *args):
+        content = self._response.read(*args)
+        current_metrics().count("responseBytes", len(content))
+        return content
+
+
+def session_urlopen(request, timeout=None):
+    """A urlopen for sgqlc that sends requests with the pooled HTTP session. timeout can be a (connect, read) tuple."""
+    import io
+    import urllib.error
+    import requests
+    from requests.structures import CaseInsensitiveDict
+    try:
+        response = clients.http_session().request(
+            request.get_method(),
+            request.full_url,
+            data=request.data,
+            headers=dict(request.header_items()),
+            timeout=timeout
+        )
+    except requests.exceptions.Timeout as error:
+        raise TimeoutError(str(error)) from error
+    except requests.exceptions.ConnectionError as error:
+        raise urllib.error.URLError(error) from error
+    # requests has already decoded the body, so sgqlc must not try to decompress it again
+    headers = CaseInsensitiveDict(response.headers)
+    headers.pop("Content-Encoding", None)
+    body = io.BytesIO(response.content)
+    if response.status_code >= 400:
+        raise urllib.error.HTTPError(request.full_url, response.status_code, response.reason, headers, body)
+    body.headers = headers
+    return body
+
+
+def metered_urlopen(request, timeout=None):
+    return _MeteredResponse(session_urlopen(request, timeout=timeout))
+
+
+class ClientRegistry:
+    """Creates clients lazily and keeps them, and their connections, for later invocations of a warm container."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._http_session = None
+        self._clients = {}
+        self._endpoints = {}
+        self.projected_query_rejected = False
+
+    def http_session(self) -> requests.Session:
+        with self._lock:
+            if self._http_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=10)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._http_session = session
+            return self._http_session
+
+    def client(self, service_name):
+        # Creating clients from boto3's default session is not thread safe, so this holds the lock
+        with self._lock:
+            if service_name not in self._clients:
+                import boto3
+                self._clients[service_name] = boto3.client(service_name)
+            return self._clients[service_name]
+
+    def graphql_endpoint(self, url) -> HTTPEndpoint:
+        with self._lock:
+            if url not in self._endpoints:
+                from sgqlc.endpoint.http import HTTPEndpoint
+                self._endpoints[url] = HTTPEndpoint(url, timeout=300, urlopen=metered_urlopen)
+            return self._endpoints[url]
+
+
+clients = ClientRegistry()
+
+
+def reset_clients():
+    clients.reset()
+
+
+class DeadlineExceededError(RuntimeError):
+    pass
+
+
+_deadline = None
+
+
+def set_deadline(lambda_context):
+    """Sets when requests must finish by: the context's remaining time less DEADLINE_MARGIN_SECONDS."""
+    global _deadline
+    _deadline = None
+    if lambda_context is not None:
+        margin = float(os.environ.get("DEADLINE_MARGIN_SECONDS", 10))
+        _deadline = time.monotonic() + lambda_context.get_remaining_time_in_millis() / 1000 - margin
+
+
+def remaining_seconds():
+    return float("inf") if _deadline is None else _deadline - time.monotonic()
+
+
+def request_timeout(read_timeout_variable, default_read_timeout):
+    """Returns the connect and read timeouts for a request, capped to the time left before the deadline."""
+    remaining = remaining_seconds()
+    if remaining <= 0:
+        raise DeadlineExceededError("No time left before the Lambda deadline to make a request")
+    connect_timeout = float(os.environ.get("CONNECT_TIMEOUT_SECONDS", 5))
+    read_timeout = float(os.environ.get(read_timeout_variable, default_read_timeout))
+    return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+
+def with_retries(send, should_retry, retryable_errors):
+    """Calls send until should_retry is false, backing off with full jitter between attempts.
+    Stops after HTTP_MAX_ATTEMPTS, or early if the backoff would run past the deadline.
+    """
+    max_attempts = max(int(os.environ.get("HTTP_MAX_ATTEMPTS", 3)), 1)
+    base_delay = float(os.environ.get("HTTP_BACKOFF_BASE_SECONDS", 0.5))
+    max_delay = float(os.environ.get("HTTP_BACKOFF_MAX_SECONDS", 8))
+    for attempt in range(1, max_attempts + 1):
+        try:
+            result = send()
+        except retryable_errors as error:
+            result, last_error = None, error
+        else:
+            if not should_retry(result):
+                return result
+            last_error = None
+        delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+        if attempt == max_attempts or delay >= remaining_seconds():
+            break
+        logger.warning(json.dumps({"attempt": attempt, "retryInSeconds": delay, "error": str(last_error or "")}))
+        time.sleep(delay)
+    if last_error is not None:
+        raise last_error
+    return result
+
+
 def get_client_secret():
     client_secret_path = os.environ["CLIENT_SECRET_PATH"]
-    ssm_client = client("ssm")
+    ssm_client = clients.client("ssm")
     response = ssm_client.get_parameter(
         Name=client_secret_path,
         WithDecryption=True
@@ -51,22 +402,175 @@ def get_client_secret():
     return response["Parameter"]["Value"]
 
 
-def get_token(client_secret):
+def request_token(client_secret):
+    import requests
     client_id = os.environ["CLIENT_ID"]
     auth_url = f'{os.environ["AUTH_URL"]}/realms/tdr/protocol/openid-connect/token'
     grant_type = {"grant_type": "client_credentials"}
-    auth_response = requests.post(auth_url, data=grant_type, auth=(client_id, client_secret))
+    auth_response = with_retries(
+        lambda: clients.http_session().post(
+            auth_url,
+            data=grant_type,
+            auth=(client_id, client_secret),
+            timeout=request_timeout("AUTH_READ_TIMEOUT_SECONDS", 30)
+        ),
+        lambda response: response.status_code >= 500,
+        (requests.exceptions.Timeout, requests.exceptions.ConnectionError)
+    )
     if auth_response.status_code != 200:
         raise RuntimeError(f"Non 200 status from Keycloak {auth_response.status_code}")
-    return auth_response.json()['access_token']
+    return auth_response.json()
+
+
+def get_token(client_secret):
+    return request_token(client_secret)['access_token']
+
+
+class CredentialCache:
+    """Keeps the client secret and access token for a warm container, refreshing the token before it expires."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._client_secret = None
+        self.invalidate_token()
+
+    def invalidate_token(self):
+        self._access_token = None
+        self._expires_at = 0.0
+
+    def get_client_secret(self):
+        with self._lock:
+            if self._client_secret is None:
+                self._client_secret = get_client_secret()
+            return self._client_secret
+
+    def get_access_token(self):
+        client_secret = self.get_client_secret()
+        with self._lock:
+            if self._access_token is None or time.monotonic() >= self._expires_at:
+                try:
+                    token = request_token(client_secret)
+                except RuntimeError:
+                    # The secret may have been rotated, so read it again next time
+                    self._client_secret = None
+                    raise
+                margin = float(os.environ.get("TOKEN_EXPIRY_MARGIN_SECONDS", 30))
+                self._access_token = token['access_token']
+                self._expires_at = time.monotonic() + token.get('expires_in', 0) - margin
+            return self._access_token
+
+
+credential_cache = CredentialCache()
+
+
+def _error_statuses(data):
+    """sgqlc puts the status on each error for non-JSON bodies, and at the top level for JSON ones."""
+    statuses = [data.get('status')] + [error.get('status') for error in data.get('errors') or []]
+    return [status for status in statuses if status is not None]
+
+
+def _is_unauthorised(data):
+    return 401 in _error_statuses(data)
+
+
+def _is_server_error(data):
+    return any(status >= 500 for status in _error_statuses(data))
+
+
+class ApiRateLimiter:
+    """Spaces this process's API requests to at most API_REQUESTS_PER_SECOND, when it is set."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_request = 0.0
+
+    def wait(self):
+        rate = float(os.environ.get("API_REQUESTS_PER_SECOND", 0))
+        if rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_request)
+            self._next_request = start + 1 / rate
+        if start > now:
+            time.sleep(start - now)
+
+
+api_rate_limiter = ApiRateLimiter()
+
+
+def call_api(query):
+    """Calls the API, retrying failures and, if the token is rejected, retrying once with a new token."""
+    import urllib.error
+    endpoint = clients.graphql_endpoint(os.environ["API_URL"])
+
+    def send():
+        api_rate_limiter.wait()
+        return endpoint(
+            query,
+            extra_headers={'Authorization': f'Bearer {credential_cache.get_access_token()}'},
+            timeout=request_timeout("API_READ_TIMEOUT_SECONDS", 300)
+        )
+
+    retryable_errors = (urllib.error.URLError, TimeoutError, ConnectionError)
+    data = with_retries(send, _is_server_error, retryable_errors)
+    if _is_unauthorised(data):
+        credential_cache.invalidate_token()
+        data = with_retries(send, _is_server_error, retryable_errors)
+    return data
+
+
+def use_projected_query():
+    if os.environ.get("PROJECTED_QUERY", "true").lower() == "false":
+        return False
+    return not clients.projected_query_rejected
+
+
+def get_file_filters():
+    """Filters the API's files to the ones of type File, with only the metadata used in the results."""
+    return {'fileTypeIdentifier': 'File', 'metadataFilters': {'properties': list(RESULT_METADATA)}}
+
+
+FILTER_ARGUMENT_NAMES = ("fileFiltersInput", "fileFilters", "FileFilters", "metadataFilters", "fileTypeIdentifier")
 
 
-def get_query(consignment_id):
-    operation = Operation(Query)
+def _is_rejected(data):
+    """Whether the API rejected the projected query's filter arguments, as opposed to failing for another reason."""
+    if 400 in _error_statuses(data):
+        return True
+    messages = [str(error.get('message', '')) for error in data.get('errors') or []]
+    return any(name in message for message in messages for name in FILTER_ARGUMENT_NAMES)
+
+
+def call_api_projected(build_query):
+    """Calls the API with the projected query, falling back to the full query if the filters are rejected.
+    Projection is only turned off for the container once the full query succeeds.
+    """
+    if not use_projected_query():
+        return call_api(build_query(False))
+    data = call_api(build_query(True))
+    if not _is_rejected(data):
+        return data
+    full_data = call_api(build_query(False))
+    if not full_data.get('errors'):
+        logger.warning(json.dumps({"projectedQueryRejected": data['errors'][0].get('message')}))
+        clients.projected_query_rejected = True
+    return full_data
+
+
+def get_query(consignment_id, projected=False):
+    from sgqlc.operation import Operation
+    operation = Operation(get_schema().Query)
     consignment = operation.getConsignment(consignmentid=consignment_id)
     consignment.consignmentType()
     consignment.userid()
-    files = consignment.files()
+    if projected:
+        files = consignment.files(fileFiltersInput=get_file_filters())
+    else:
+        files = consignment.files()
     files.fileId()
     files.uploadMatchId()
     files.fileType()
@@ -74,19 +578,76 @@ def get_query(consignment_id):
     return operation
 
 
+def get_paginated_query(consignment_id, page_size, cursor=None, projected=False):
+    from sgqlc.operation import Operation
+    operation = Operation(get_schema().Query)
+    consignment = operation.getConsignment(consignmentid=consignment_id)
+    consignment.consignmentType()
+    consignment.userid()
+    pagination_input = {'limit': page_size, 'currentCursor': cursor}
+    if projected:
+        pagination_input['fileFilters'] = get_file_filters()
+    paginated_files = consignment.paginatedFiles(paginationInput=pagination_input)
+    paginated_files.page_info.__fields__('has_next_page', 'end_cursor')
+    files = paginated_files.edges().node()
+    files.fileId()
+    files.uploadMatchId()
+    files.fileType()
+    files.fileMetadata()
+    return operation
+
+
+def get_files_page_size():
+    return int(os.environ.get("FILES_PAGE_SIZE", 0))
+
+
+def iter_consignment_pages(execute, consignment_id, page_size) -> Iterator[dict]:
+    """Yields the decoded consignment one page of files at a time, following the end cursor."""
+    cursor = None
+    while True:
+        data = execute(lambda projected: get_paginated_query(consignment_id, page_size, cursor, projected))
+        if 'errors' in data:
+            raise Exception("Error in response", data['errors'])
+        page = data['data']['getConsignment']
+        yield page
+        page_info = page['paginatedFiles']['pageInfo']
+        if not page_info['hasNextPage']:
+            return
+        cursor = page_info['endCursor']
+
+
+def iter_page_files(pages: Iterable[dict]) -> Iterator[dict]:
+    for page in pages:
+        for edge in page['paginatedFiles']['edges']:
+            yield edge['node']
+
+
 def get_metadata_value(file, name):
     return [data['value'] for data in file.fileMetadata if data.name == name][0]
 
 
+RESULT_METADATA = ("ClientSideOriginalFilepath", "ClientSideFileSize", "SHA256ClientSideChecksum")
+
+
+def get_metadata_values(file: dict):
+    """Collects the result metadata in one pass. As with get_metadata_value, the first value wins."""
+    values = {}
+    for metadata in file['fileMetadata']:
+        name = metadata['name']
+        if name in RESULT_METADATA and name not in values:
+            values[name] = metadata['value']
+    return values
+
+
 def _override_object_identifier(prefix: str):
     override_prefixes = {"sharepoint", "harddrive", "networkdrive"}
     return any(s in prefix for s in override_prefixes)
 
 
-def get_object_identifier(prefix, file: File):
-    obj_identifier = file.fileId
+def get_object_identifier(prefix, file: Union[File, dict]):
+    obj_identifier = file['fileId']
     if _override_object_identifier(prefix):
-        obj_identifier = file.uploadMatchId
+        obj_identifier = file['uploadMatchId']
     return obj_identifier
 
 
@@ -107,20 +668,319 @@ def process_file(s3_source_bucket, prefix, file: File):
     }
 
 
+def process_file_json(s3_source_bucket, prefix, file: dict):
+    """Builds the same result as process_file, working directly on the decoded API response."""
+    obj_identifier = get_object_identifier(prefix, file)
+    metadata = get_metadata_values(file)
+    return {
+        's3SourceBucket': s3_source_bucket,
+        's3SourceBucketKey': f'{prefix}/{obj_identifier}',
+        'fileId': file['fileId'],
+        'originalPath': metadata["ClientSideOriginalFilepath"],
+        'fileSize': metadata["ClientSideFileSize"],
+        "clientChecksum": metadata["SHA256ClientSideChecksum"],
+        "fileCheckResults": {
+            "antivirus": [],
+            "checksum": [],
+            "fileFormat": []
+        }
+    }
+
+
+COMPACT_RESULT_FIELDS = ["fileId", "objectIdentifier", "originalPath", "fileSize", "clientChecksum"]
+
+
+def compact_result(prefix, file: dict):
+    """Builds a version 2 result record: the per-file values of process_file_json in COMPACT_RESULT_FIELDS order."""
+    metadata = get_metadata_values(file)
+    return [
+        file['fileId'],
+        get_object_identifier(prefix, file),
+        metadata["ClientSideOriginalFilepath"],
+        metadata["ClientSideFileSize"],
+        metadata["SHA256ClientSideChecksum"]
+    ]
+
+
+def compact_results_header(s3_source_bucket, prefix, consignment_type, consignment_id, user_id):
+    return {
+        's3SourceBucket': s3_source_bucket,
+        's3SourceBucketKeyPrefix': prefix,
+        'consignmentType': consignment_type,
+        'consignmentId': consignment_id,
+        'userId': user_id
+    }
+
+
+def expand_results(document: dict) -> dict:
+    """Returns a results document in the original shape, expanding it if it is in the compact version 2 format."""
+    if document.get("version") != 2:
+        return document
+    header = document["header"]
+    fields = document["fields"]
+    results = []
+    for record in document["results"]:
+        values = dict(zip(fields, record))
+        results.append({
+            's3SourceBucket': header['s3SourceBucket'],
+            's3SourceBucketKey': f"{header['s3SourceBucketKeyPrefix']}/{values['objectIdentifier']}",
+            'fileId': values['fileId'],
+            'originalPath': values['originalPath'],
+            'fileSize': values['fileSize'],
+            "clientChecksum": values['clientChecksum'],
+            "fileCheckResults": {
+                "antivirus": [],
+                "checksum": [],
+                "fileFormat": []
+            },
+            'consignmentType': header['consignmentType'],
+            'consignmentId': header['consignmentId'],
+            'userId': header['userId']
+        })
+    return {"results": results} | {
+        key: value for key, value in document.items() if key not in ("version", "header", "fields", "results")
+    }
+
+
+def deduplicate_results():
+    return os.environ.get("DEDUPLICATE_RESULTS", "false").lower() == "true"
+
+
+class DuplicateGrouper:
+    """Passes on the first file for each checksum and size, and maps its file id to the ids of the rest in
+    duplicates. Files without a checksum or size are never grouped.
+    """
+
+    def __init__(self):
+        self.duplicates = {}
+        self._representatives = {}
+
+    def representatives(self, files: Iterable[dict]) -> Iterator[dict]:
+        for file in files:
+            metadata = get_metadata_values(file)
+            checksum = metadata.get("SHA256ClientSideChecksum")
+            size = metadata.get("ClientSideFileSize")
+            if file['fileType'] != "File" or checksum is None or size is None:
+                yield file
+                continue
+            representative_id = self._representatives.setdefault((checksum, size), file['fileId'])
+            if representative_id == file['fileId']:
+                yield file
+            else:
+                self.duplicates.setdefault(representative_id, []).append(file['fileId'])
+                current_metrics().count("duplicateFiles")
+
+
+S3_LIST_PAGE_SIZE = 1000
+UUID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+UUID_SHARDS = "0123456789abcdef"
+
+
+def _list_object_sizes(s3_source_bucket, prefix, continuation_token=None):
+    s3 = clients.client("s3")
+    sizes = {}
+    while True:
+        args = {"Bucket": s3_source_bucket, "Prefix": prefix, "MaxKeys": S3_LIST_PAGE_SIZE}
+        if continuation_token is not None:
+            args["ContinuationToken"] = continuation_token
+        page = s3.list_objects_v2(**args)
+        sizes.update((entry["Key"].rsplit("/", 1)[1], entry["Size"]) for entry in page.get("Contents", []))
+        if not page.get("IsTruncated"):
+            return sizes
+        continuation_token = page["NextContinuationToken"]
+
+
+# The ranges of object names that do not start with a lowercase hex character, as (start after, stop at) pairs.
+# U+10FFFF sorts after every other character, so starting after it skips the whole shard.
+UUID_SHARD_GAPS = ((None, "0"), ("9\U0010ffff", "a"), ("f\U0010ffff", None))
+
+
+def _list_object_sizes_between(s3_source_bucket, prefix, start_after=None, stop_at=None):
+    """Lists the names under the prefix between start_after and stop_at that are not in a hex shard."""
+    s3 = clients.client("s3")
+    sizes = {}
+    args = {"Bucket": s3_source_bucket, "Prefix": f"{prefix}/", "MaxKeys": S3_LIST_PAGE_SIZE}
+    if start_after is not None:
+        args["StartAfter"] = f"{prefix}/{start_after}"
+    while True:
+        page = s3.list_objects_v2(**args)
+        for entry in page.get("Contents", []):
+            name = entry["Key"][len(prefix) + 1:]
+            if stop_at is not None and name >= stop_at:
+                return sizes
+            if name[:1] not in UUID_SHARDS:
+                sizes[name.rsplit("/", 1)[-1]] = entry["Size"]
+        if not page.get("IsTruncated"):
+            return sizes
+        args["ContinuationToken"] = page["NextContinuationToken"]
+
+
+def s3_list_file_sizes_sharded(s3_source_bucket, prefix, concurrency):
+    """Lists a prefix of UUID names as 16 hex shards in parallel, plus the names outside them.
+    A prefix with one page, or with non-UUID names on its first page, is listed serially.
+    """
+    s3 = clients.client("s3")
+    first_page = s3.list_objects_v2(Bucket=s3_source_bucket, Prefix=prefix, MaxKeys=S3_LIST_PAGE_SIZE)
+    sizes = {entry["Key"].rsplit("/", 1)[1]: entry["Size"] for entry in first_page.get("Contents", [])}
+    if not first_page.get("IsTruncated"):
+        return sizes
+    if not all(UUID_PATTERN.fullmatch(name) for name in sizes):
+        return sizes | _list_object_sizes(s3_source_bucket, prefix, first_page["NextContinuationToken"])
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        shards = executor.map(lambda shard: _list_object_sizes(s3_source_bucket, f"{prefix}/{shard}"), UUID_SHARDS)
+        gaps = executor.map(lambda gap: _list_object_sizes_between(s3_source_bucket, prefix, *gap), UUID_SHARD_GAPS)
+        return {name: size for listing in itertools.chain(shards, gaps) for name, size in listing.items()}
+
+
+def get_s3_list_concurrency():
+    return int(os.environ.get("S3_LIST_CONCURRENCY", 0))
+
+
+def s3_list_file_sizes(s3_source_bucket, prefix) -> dict:
+    """Returns the size of each object under the prefix, keyed by object name."""
+    concurrency = get_s3_list_concurrency()
+    if concurrency > 0:
+        return s3_list_file_sizes_sharded(s3_source_bucket, prefix, concurrency)
+    return _list_object_sizes(s3_source_bucket, prefix)
+
+
 def s3_list_files(s3_source_bucket, prefix):
-    s3 = resource("s3")
-    bucket = s3.Bucket(s3_source_bucket)
-    objs = bucket.objects.filter(Prefix=prefix)
-    return [entry.key.rsplit("/", 1)[1] for entry in objs]
+    return list(s3_list_file_sizes(s3_source_bucket, prefix))
+
+
+@dataclass(frozen=True)
+class ReconciliationReport:
+    missing_count: int
+    extra_count: Optional[int]
+    missing_sample: tuple = ()
+    extra_sample: tuple = ()
+    stopped_early: bool = False
+    size_mismatch_count: int = 0
+    size_mismatch_sample: tuple = ()
+
+    @property
+    def matched(self):
+        return self.missing_count == 0 and self.extra_count == 0 and self.size_mismatch_count == 0
+
+    def to_dict(self):
+        return {
+            "missingCount": self.missing_count,
+            "extraCount": self.extra_count,
+            "sizeMismatchCount": self.size_mismatch_count,
+            "missingSample": list(self.missing_sample),
+            "extraSample": list(self.extra_sample),
+            "sizeMismatchSample": list(self.size_mismatch_sample),
+            "stoppedEarly": self.stopped_early
+        }
+
+
+class UploadMismatchError(RuntimeError):
+    def __init__(self, prefix, report: ReconciliationReport):
+        super().__init__(f"Uploaded files do not match files from the API for {prefix}", report.to_dict())
+        self.report = report
+
+    def __str__(self):
+        return f"{self.args[0]}: {json.dumps(self.args[1])}"
+
+
+def get_file_size(file) -> Optional[int]:
+    size = get_metadata_values(file).get("ClientSideFileSize")
+    try:
+        return int(size)
+    except (TypeError, ValueError):
+        return None
+
+
+class FileReconciler:
+    """Matches API identifiers against the S3 listing, and sizes too when the listing has them.
+    add returns False once RECONCILIATION_MAX_MISMATCHES files are missing or the wrong size.
+    """
+
+    def __init__(self, s3_files: Iterable[str]):
+        self._unmatched = set(s3_files)
+        self._sizes = s3_files if isinstance(s3_files, dict) else None
+        if os.environ.get("VERIFY_FILE_SIZES", "true").lower() == "false":
+            self._sizes = None
+        self._sample_size = int(os.environ.get("RECONCILIATION_SAMPLE_SIZE", 10))
+        self._max_mismatches = int(os.environ.get("RECONCILIATION_MAX_MISMATCHES", 0))
+        self._missing_count = 0
+        self._missing_sample = []
+        self._size_mismatch_count = 0
+        self._size_mismatch_sample = []
+
+    def add(self, identifier, expected_size: Optional[int] = None) -> bool:
+        if identifier in self._unmatched:
+            self._unmatched.remove(identifier)
+            if self._sizes is not None and expected_size is not None and self._sizes[identifier] != expected_size:
+                self._size_mismatch_count += 1
+                if len(self._size_mismatch_sample) < self._sample_size:
+                    self._size_mismatch_sample.append(
+                        {"identifier": identifier, "expectedSize": expected_size, "listedSize": self._sizes[identifier]}
+                    )
+        else:
+            self._missing_count += 1
+            if len(self._missing_sample) < self._sample_size:
+                self._missing_sample.append(identifier)
+        mismatches = self._missing_count + self._size_mismatch_count
+        return self._max_mismatches <= 0 or mismatches < self._max_mismatches
+
+    def report(self, stopped_early=False) -> ReconciliationReport:
+        sizes = {
+            "size_mismatch_count": self._size_mismatch_count,
+            "size_mismatch_sample": tuple(self._size_mismatch_sample)
+        }
+        if stopped_early:
+            return ReconciliationReport(
+                self._missing_count, None, tuple(self._missing_sample), stopped_early=True, **sizes
+            )
+        return ReconciliationReport(
+            missing_count=self._missing_count,
+            extra_count=len(self._unmatched),
+            missing_sample=tuple(self._missing_sample),
+            extra_sample=tuple(heapq.nsmallest(self._sample_size, self._unmatched)),
+            **sizes
+        )
+
+
+def reconcile_files(api_files: Iterable[str], s3_files: Iterable[str]) -> ReconciliationReport:
+    reconciler = FileReconciler(s3_files)
+    for identifier in api_files:
+        if not reconciler.add(identifier):
+            return reconciler.report(stopped_early=True)
+    return reconciler.report()
 
 
-def validate_all_files_uploaded(s3_source_bucket, prefix, consignment: Consignment):
-    api_files = [get_object_identifier(prefix, file) for file in consignment.files if file.fileType == "File"]
-    s3_files = s3_list_files(s3_source_bucket, prefix)
-    api_files.sort()
-    s3_files.sort()
-    if api_files != s3_files:
-        raise RuntimeError(f"Uploaded files do not match files from the API for {prefix}")
+def raise_if_mismatched(prefix, report: ReconciliationReport):
+    if not report.matched:
+        logger.error(json.dumps({"prefix": prefix, "reconciliation": report.to_dict()}))
+        raise UploadMismatchError(prefix, report)
+
+
+def validate_all_files_uploaded(s3_source_bucket, prefix, consignment: Union[Consignment, dict], s3_files=None):
+    if s3_files is None:
+        s3_files = s3_list_file_sizes(s3_source_bucket, prefix)
+    reconciler = FileReconciler(s3_files)
+    report = None
+    for file in consignment['files']:
+        if file['fileType'] == "File" and not reconciler.add(get_object_identifier(prefix, file), get_file_size(file)):
+            report = reconciler.report(stopped_early=True)
+            break
+    report = report or reconciler.report()
+    raise_if_mismatched(prefix, report)
+    return report
+
+
+def iter_validated_files(s3_source_bucket, prefix, files: Iterable[dict], s3_files=None) -> Iterator[dict]:
+    """Yields the files of type File as pages arrive, checking them against S3 as they go."""
+    if s3_files is None:
+        s3_files = s3_list_file_sizes(s3_source_bucket, prefix)
+    reconciler = FileReconciler(s3_files)
+    for file in files:
+        if file['fileType'] == "File":
+            if not reconciler.add(get_object_identifier(prefix, file), get_file_size(file)):
+                raise_if_mismatched(prefix, reconciler.report(stopped_early=True))
+            yield file
+    raise_if_mismatched(prefix, reconciler.report())
 
 
 def consignment_statuses(consignment_id, status_name, status_value='InProgress', overwrite=False):
@@ -133,15 +993,359 @@ def consignment_statuses(consignment_id, status_name, status_value='InProgress',
     }
 
 
-def write_results_json(json_result, consignment_id):
-    s3 = client("s3")
-    key = f"{consignment_id}/{uuid.uuid4()}/results.json"
+class S3MultipartWriter:
+    """Uploads writes in fixed-size multipart upload parts, or with one put_object if they fit in a part."""
+
+    def __init__(self, s3, bucket, key, part_size=DEFAULT_PART_SIZE, object_args=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.object_args = object_args or {}
+        self._buffer = bytearray()
+        self._parts = []
+        self._upload_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data: bytes):
+        current_metrics().count("resultBytes", len(data))
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            with memoryview(self._buffer) as view:
+                part = bytes(view[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._upload_part(part)
+
+    def close(self):
+        with current_metrics().span("s3Put"):
+            if self._upload_id is None:
+                self.s3.put_object(Body=self._buffer, Bucket=self.bucket, Key=self.key, **self.object_args)
+            else:
+                try:
+                    if self._buffer:
+                        self._upload_part(self._buffer)
+                    self.s3.complete_multipart_upload(
+                        Bucket=self.bucket,
+                        Key=self.key,
+                        UploadId=self._upload_id,
+                        MultipartUpload={"Parts": self._parts}
+                    )
+                except BaseException:
+                    self.abort()
+                    raise
+        self._buffer = bytearray()
+
+    def abort(self):
+        if self._upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+        self._buffer = bytearray()
+
+    def _upload_part(self, body: Union[bytes, bytearray]):
+        with current_metrics().span("s3Put"):
+            if self._upload_id is None:
+                self._upload_id = self.s3.create_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, **self.object_args
+                )["UploadId"]
+            part_number = len(self._parts) + 1
+            response = self.s3.upload_part(
+                Body=body,
+                Bucket=self.bucket,
+                Key=self.key,
+                PartNumber=part_number,
+                UploadId=self._upload_id
+            )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+
+RESULTS_COMPRESSION_SUFFIXES = {"none": "", "gzip": ".gz"}
+
+
+def _compressor(compression):
+    if compression == "gzip":
+        # wbits of 31 writes a gzip header and trailer around the deflate stream
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    raise ValueError(f"Unknown results compression {compression}")
+
+
+class CompressingWriter:
+    """Compresses writes as they arrive and passes them on to another writer."""
+
+    def __init__(self, writer, compression):
+        self.writer = writer
+        self._compressor = _compressor(compression)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data: bytes):
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self.writer.write(compressed)
+
+    def close(self):
+        self.writer.write(self._compressor.flush())
+        self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
+
+
+def get_results_compression():
+    compression = os.environ.get("RESULTS_COMPRESSION", "none")
+    if compression not in RESULTS_COMPRESSION_SUFFIXES:
+        raise ValueError(f"Unknown results compression {compression}")
+    return compression
+
+
+def read_results(bucket, key, s3=None) -> dict:
+    """Loads a results document or manifest from S3, decompressing it if it was written with RESULTS_COMPRESSION."""
+    s3 = s3 or clients.client("s3")
+    obj = s3.get_object(Bucket=bucket, Key=key)
+    encoding = obj.get("ContentEncoding")
+    body = obj["Body"]
+    if encoding == "gzip":
+        import gzip
+        with gzip.GzipFile(fileobj=body) as stream:
+            return json.load(stream)
+    return json.loads(body.read().decode("utf-8"))
+
+
+def get_results_part_size():
+    part_size = int(os.environ.get("RESULTS_PART_SIZE_BYTES", DEFAULT_PART_SIZE))
+    return max(part_size, MIN_PART_SIZE)
+
+
+def iter_json(value) -> Iterator[str]:
+    """Yields the same JSON as json.dumps(value) in chunks, writing iterators as arrays one item at a time."""
+    if isinstance(value, dict):
+        yield '{'
+        for index, (key, item) in enumerate(value.items()):
+            yield f'{", " if index else ""}{json.dumps(key)}: '
+            yield from iter_json(item)
+        yield '}'
+    elif isinstance(value, Iterator):
+        yield '['
+        for index, item in enumerate(value):
+            yield f'{", " if index else ""}{json.dumps(item)}'
+        yield ']'
+    else:
+        yield json.dumps(value)
+
+
+class ShardedJsonLinesWriter:
+    """Writes items as JSON Lines across S3 objects, starting a new one before a line would exceed max_bytes."""
+
+    def __init__(self, s3, bucket, key_prefix, max_bytes=DEFAULT_SHARD_MAX_BYTES, part_size=DEFAULT_PART_SIZE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key_prefix = key_prefix
+        self.max_bytes = max_bytes
+        self.part_size = part_size
+        self.shards = []
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, item):
+        line = f"{json.dumps(item)}\n".encode("utf-8")
+        shard = self.shards[-1] if self._writer is not None else None
+        if shard is None or (shard["resultCount"] > 0 and shard["bytes"] + len(line) > self.max_bytes):
+            self._start_shard()
+            shard = self.shards[-1]
+        self._writer.write(line)
+        shard["resultCount"] += 1
+        shard["bytes"] += len(line)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        return self.shards
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.abort()
+            self.shards.pop()
+            self._writer = None
+        for shard in self.shards:
+            self.s3.delete_object(Bucket=shard["bucket"], Key=shard["key"])
+        self.shards = []
+
+    def _start_shard(self):
+        self.close()
+        key = f"{self.key_prefix}/results-{len(self.shards):05d}.jsonl"
+        self._writer = S3MultipartWriter(self.s3, self.bucket, key, self.part_size)
+        self.shards.append({"bucket": self.bucket, "key": key, "resultCount": 0, "bytes": 0})
+
+
+def get_results_format():
+    return os.environ.get("RESULTS_FORMAT", "json")
+
+
+def get_results_shard_max_bytes():
+    return int(os.environ.get("RESULTS_SHARD_MAX_BYTES", DEFAULT_SHARD_MAX_BYTES))
+
+
+def results_key_prefix(consignment_id, fingerprint=None):
+    return f"{consignment_id}/{fingerprint or uuid.uuid4()}"
+
+
+def results_object_name():
+    if get_results_format() == "jsonl":
+        return "manifest.json"
+    return f"results.json{RESULTS_COMPRESSION_SUFFIXES[get_results_compression()]}"
+
+
+def results_output_settings():
+    """The settings that change what is written, so they are part of the results fingerprint."""
+    return {
+        "resultsFormat": get_results_format(),
+        "resultsCompression": get_results_compression(),
+        "deduplicateResults": deduplicate_results(),
+        "batches": get_batch_settings()
+    }
+
+
+def get_batch_settings():
+    """Returns RESULTS_BATCH_COUNT and RESULTS_BATCH_TARGET_BYTES. Batching is off while both are zero."""
+    return int(os.environ.get("RESULTS_BATCH_COUNT", 0)), int(os.environ.get("RESULTS_BATCH_TARGET_BYTES", 0))
+
+
+def balance_files(files: Iterable[dict], batch_count=0, target_bytes=0):
+    """Places files largest first into the lightest of batch_count batches, or more to stay near target_bytes.
+    Returns the files batch by batch, and each batch's first result, result count and bytes.
+    """
+    files = [file for file in files if file['fileType'] == "File"]
+    sizes = [get_file_size(file) or 0 for file in files]
+    count = batch_count
+    if target_bytes > 0:
+        count = max(count, -(-sum(sizes) // target_bytes))
+    count = min(max(count, 1), max(len(files), 1))
+    batches = [[] for _ in range(count)]
+    totals = [0] * count
+    heap = [(0, index) for index in range(count)]
+    for position in sorted(range(len(files)), key=lambda position: -sizes[position]):
+        total, index = heapq.heappop(heap)
+        batches[index].append(files[position])
+        totals[index] = total + sizes[position]
+        heapq.heappush(heap, (totals[index], index))
+    order = sorted(range(count), key=lambda index: -totals[index])
+    ordered_files = []
+    summaries = []
+    for index in order:
+        summaries.append({
+            "firstResult": len(ordered_files),
+            "resultCount": len(batches[index]),
+            "bytes": totals[index]
+        })
+        ordered_files.extend(batches[index])
+    return ordered_files, summaries
+
+
+def fingerprint_results(s3_source_bucket, prefix, consignment: dict, s3_files: Iterable[str]):
+    """Hashes the API response, S3 listing and output settings, independently of their order."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        "s3SourceBucket": s3_source_bucket,
+        "prefix": prefix,
+        "consignmentType": consignment['consignmentType'],
+        "userid": consignment['userid']
+    } | results_output_settings(), sort_keys=True).encode("utf-8"))
+    for file_digest in sorted(hashlib.sha256(json.dumps(file, sort_keys=True).encode("utf-8")).digest()
+                              for file in consignment['files']):
+        digest.update(file_digest)
+    for name in sorted(s3_files):
+        size = s3_files[name] if isinstance(s3_files, dict) else ""
+        digest.update(f"{name} {size}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def find_existing_results(consignment_id, fingerprint):
+    """Returns results already written for this fingerprint.
+    A 403 counts as none, since S3 returns one for a missing key without s3:ListBucket.
+    """
+    from botocore.exceptions import ClientError
     bucket = os.environ["BACKEND_CHECKS_BUCKET_NAME"]
-    s3.put_object(
-        Body=json_result,
-        Bucket=bucket,
-        Key=key,
-    )
+    key = f"{results_key_prefix(consignment_id, fingerprint)}/{results_object_name()}"
+    try:
+        clients.client("s3").head_object(Bucket=bucket, Key=key)
+    except ClientError as error:
+        code = error.response["Error"]["Code"]
+        if code in ("404", "NoSuchKey"):
+            return None
+        if code in ("403", "AccessDenied"):
+            logger.warning(json.dumps({"existingResultsCheckDenied": {"bucket": bucket, "key": key}}))
+            return None
+        raise
+    return {
+        "key": key,
+        "bucket": bucket
+    }
+
+
+def write_results_jsonl(results: Iterable[dict], document: dict, consignment_id, fingerprint=None):
+    """Writes the results as JSON Lines shards and returns the location of a manifest listing them."""
+    s3 = clients.client("s3")
+    key_prefix = results_key_prefix(consignment_id, fingerprint)
+    bucket = os.environ["BACKEND_CHECKS_BUCKET_NAME"]
+    shard_max_bytes = get_results_shard_max_bytes()
+    with ShardedJsonLinesWriter(s3, bucket, key_prefix, shard_max_bytes, get_results_part_size()) as writer:
+        for result in results:
+            writer.write(result)
+    manifest = {
+        "resultsFormat": "jsonl",
+        "resultCount": sum(shard["resultCount"] for shard in writer.shards),
+        "shards": writer.shards
+    } | document
+    key = f"{key_prefix}/manifest.json"
+    body = json.dumps(manifest).encode("utf-8")
+    current_metrics().count("resultBytes", len(body))
+    with current_metrics().span("s3Put"):
+        s3.put_object(Body=body, Bucket=bucket, Key=key)
+    return {
+        "key": key,
+        "bucket": bucket
+    }
+
+
+def write_results_json(json_result: Union[str, Iterable[str]], consignment_id, fingerprint=None):
+    """Streams the results to S3, compressing them as they are written when RESULTS_COMPRESSION is set."""
+    s3 = clients.client("s3")
+    compression = get_results_compression()
+    key = f"{results_key_prefix(consignment_id, fingerprint)}/results.json{RESULTS_COMPRESSION_SUFFIXES[compression]}"
+    bucket = os.environ["BACKEND_CHECKS_BUCKET_NAME"]
+    chunks = [json_result] if isinstance(json_result, str) else json_result
+    object_args = {"ContentType": "application/json"}
+    if compression != "none":
+        object_args["ContentEncoding"] = compression
+    writer = S3MultipartWriter(s3, bucket, key, get_results_part_size(), object_args)
+    if compression != "none":
+        writer = CompressingWriter(writer, compression)
+    with writer:
+        for chunk in chunks:
+            writer.write(chunk.encode("utf-8"))
     return {
         "key": key,
         "bucket": bucket
@@ -160,30 +1364,72 @@ def build_settings(event: dict) -> BuildSettings:
     )
 
 
-def handler(event, lambda_context):
-    settings = build_settings(event)
+def process_consignment(settings: BuildSettings, metrics: Metrics):
     consignment_id = settings.consignment_id
     s3_source_bucket = settings.s3_source_bucket
+    timer = StageTimer()
 
-    query = get_query(consignment_id)
-    client_secret = get_client_secret()
-    api_url = os.environ["API_URL"]
-    headers = {'Authorization': f'Bearer {get_token(client_secret)}'}
-    endpoint = HTTPEndpoint(api_url, headers, 300)
-    data = endpoint(query)
-    if 'errors' in data:
-        raise Exception("Error in response", data['errors'])
-    consignment = (query + data).getConsignment
-    user_id = consignment.userid
-    prefix = f"{user_id}/{consignment_id}"
-    if settings.s3_source_bucket_prefix is not None:
-        prefix = settings.s3_source_bucket_prefix
-    validate_all_files_uploaded(s3_source_bucket, prefix, consignment)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        client_secret_future = timer.submit(executor, "clientSecret", credential_cache.get_client_secret)
+        s3_files_future = None
+        if settings.s3_source_bucket_prefix is not None:
+            s3_files_future = timer.submit(
+                executor, "s3List", s3_list_file_sizes, s3_source_bucket, settings.s3_source_bucket_prefix
+            )
+        timer.result("clientSecret", client_secret_future)
+        timer.run("token", credential_cache.get_access_token)
+        page_size = get_files_page_size()
+        if page_size > 0:
+            pages = iter_consignment_pages(call_api_projected, consignment_id, page_size)
+            consignment = timer.run("graphql", next, pages)
+            files = iter_page_files(itertools.chain([consignment], pages))
+        else:
+            data = timer.run("graphql", call_api_projected, lambda projected: get_query(consignment_id, projected))
+            if 'errors' in data:
+                raise Exception("Error in response", data['errors'])
+            consignment = data['data']['getConsignment']
+            files = consignment['files']
+        user_id = consignment['userid']
+        prefix = f"{user_id}/{consignment_id}"
+        if settings.s3_source_bucket_prefix is not None:
+            prefix = settings.s3_source_bucket_prefix
+            s3_files = timer.result("s3List", s3_files_future)
+        else:
+            s3_files = timer.run("s3List", s3_list_file_sizes, s3_source_bucket, prefix)
+    timer.log(consignment_id)
+    timer.record(metrics)
+    metrics.count("listedKeys", len(s3_files))
+
+    fingerprint = None
+    if page_size > 0:
+        files = iter_validated_files(s3_source_bucket, prefix, files, s3_files)
+    else:
+        with metrics.span("reconcile"):
+            validate_all_files_uploaded(s3_source_bucket, prefix, consignment, s3_files)
+        with metrics.span("fingerprint"):
+            fingerprint = fingerprint_results(s3_source_bucket, prefix, consignment, s3_files)
+            existing_results = find_existing_results(consignment_id, fingerprint)
+        if existing_results is not None:
+            logger.info(json.dumps({"consignmentId": consignment_id, "existingResults": existing_results}))
+            metrics.count("reusedResults")
+            return existing_results
     status_names = ['ServerFFID', 'ServerChecksum', 'ServerAntivirus', 'ServerRedaction']
-    results = {
-        "results": [process_file(s3_source_bucket, prefix, file) |
-                    {'consignmentType': consignment.consignmentType, 'consignmentId': consignment_id, 'userId': user_id}
-                    for file in consignment.files if file.fileType == "File"],
+    results_format = get_results_format()
+    grouper = DuplicateGrouper() if deduplicate_results() else None
+    if grouper is not None:
+        files = grouper.representatives(files)
+    batch_count, batch_target_bytes = get_batch_settings()
+    batches = None
+    if batch_count > 0 or batch_target_bytes > 0:
+        with metrics.span("balanceBatches"):
+            files, batches = balance_files(files, batch_count, batch_target_bytes)
+    if results_format == "compact":
+        results = counted((compact_result(prefix, file) for file in files if file['fileType'] == "File"), "fileCount")
+    else:
+        shared = {'consignmentType': consignment['consignmentType'], 'consignmentId': consignment_id, 'userId': user_id}
+        results = counted((process_file_json(s3_source_bucket, prefix, file) | shared
+                           for file in files if file['fileType'] == "File"), "fileCount")
+    document = {
         "statuses": {
             "statuses": [consignment_statuses(consignment_id, status_name) for status_name in status_names]
         },
@@ -192,8 +1438,67 @@ def handler(event, lambda_context):
             "errors": []
         }
     }
-    bucket_info = write_results_json(json.dumps(results), consignment_id)
+    if grouper is not None:
+        # The results are streamed before the rest of the document, so the mapping is complete by the time it is written
+        document["duplicateFiles"] = grouper.duplicates
+    if batches is not None:
+        document["batches"] = batches
+    with metrics.span("writeResults"):
+        if results_format == "jsonl":
+            bucket_info = write_results_jsonl(results, document, consignment_id, fingerprint)
+        elif results_format == "compact":
+            header = compact_results_header(
+                s3_source_bucket, prefix, consignment['consignmentType'], consignment_id, user_id
+            )
+            compact_document = {"version": 2, "header": header, "fields": COMPACT_RESULT_FIELDS, "results": results}
+            bucket_info = write_results_json(iter_json(compact_document | document), consignment_id, fingerprint)
+        else:
+            bucket_info = write_results_json(iter_json({"results": results} | document), consignment_id, fingerprint)
     return {
         "key": bucket_info["key"],
         "bucket": bucket_info["bucket"]
     }
+
+
+def run_consignment(settings: BuildSettings):
+    with Metrics(settings.consignment_id).activate() as metrics:
+        try:
+            return process_consignment(settings, metrics)
+        finally:
+            metrics.emit()
+
+
+def run_batch_consignment(event: dict, consignment_id):
+    try:
+        if consignment_id is None:
+            raise ValueError("Batch entry has no consignmentId")
+        settings = build_settings(event | {"consignmentId": consignment_id})
+        return {"consignmentId": consignment_id} | run_consignment(settings)
+    except Exception as error:
+        logger.exception(f"Failed to process consignment {consignment_id}")
+        return {"consignmentId": consignment_id, "error": {"type": type(error).__name__, "message": str(error)}}
+
+
+def handle_batch(event: dict):
+    """Processes each consignment id or event in consignmentIds on BATCH_CONCURRENCY threads.
+    A consignment that fails is reported with its error rather than failing the batch.
+    """
+    shared_event = {key: value for key, value in event.items() if key != "consignmentIds"}
+    consignment_events = [
+        shared_event | (entry if isinstance(entry, dict) else {"consignmentId": entry})
+        for entry in event["consignmentIds"]
+    ]
+    concurrency = int(os.environ.get("BATCH_CONCURRENCY", 4))
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        results = list(executor.map(
+            lambda consignment_event: run_batch_consignment(consignment_event, consignment_event.get("consignmentId")),
+            consignment_events
+        ))
+    return {"consignments": results}
+
+
+def handler(event, lambda_context):
+    set_deadline(lambda_context)
+    if "consignmentIds" in event:
+        return handle_batch(event)
+    return run_consignment(build_settings(event))
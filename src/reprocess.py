@@ -0,0 +1,156 @@
+"""Regenerates results for many consignments from outside Lambda.
+
+Run from the repository root with the same environment variables as the lambda, for example:
+
+    python -m src.reprocess consignments.txt --summary summary.jsonl --concurrency 8 --api-rate 20
+
+Each line of the input, or of stdin when it is -, is either a consignment id or a JSON event such as
+{"consignmentId": "...", "s3SourceBucketPrefix": "..."}. One JSON line per consignment is appended to the
+summary as it finishes. Consignments that already succeeded in the summary are skipped, so a stopped
+run can be restarted with the same arguments and carries on where it left off.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from src import lambda_handler
+
+
+def read_events(lines, error_stream=None):
+    """Yields an event for each consignment id or JSON event line, reporting and skipping invalid lines."""
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith("{"):
+            yield {"consignmentId": line}
+            continue
+        try:
+            event = json.loads(line)
+        except json.JSONDecodeError as error:
+            print(f"Skipping line {number}, which is not valid JSON: {error}", file=error_stream or sys.stderr)
+            continue
+        if not event.get("consignmentId"):
+            print(f"Skipping line {number}, which has no consignmentId", file=error_stream or sys.stderr)
+            continue
+        yield event
+
+
+def read_succeeded(summary_path):
+    """Returns the ids of the consignments the summary records as succeeded. A later failure overrides a success."""
+    succeeded = set()
+    if not os.path.exists(summary_path):
+        return succeeded
+    with open(summary_path) as summary:
+        for line in summary:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "error" in entry:
+                succeeded.discard(entry["consignmentId"])
+            else:
+                succeeded.add(entry["consignmentId"])
+    return succeeded
+
+
+def configure_worker(api_requests_per_second):
+    # The metrics line each consignment prints would be mixed in with the totals on stdout
+    os.environ["METRICS_LEVEL"] = "none"
+    if api_requests_per_second:
+        os.environ["API_REQUESTS_PER_SECOND"] = str(api_requests_per_second)
+
+
+@contextmanager
+def worker_environment(api_requests_per_second):
+    """Configures this process as a worker, restoring its environment afterwards."""
+    saved = os.environ.copy()
+    configure_worker(api_requests_per_second)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def process_event(event):
+    return lambda_handler.run_batch_consignment(event, event["consignmentId"])
+
+
+class Progress:
+    """Prints how many consignments have finished, how many failed and the throughput so far."""
+
+    def __init__(self, total, stream=None):
+        self.total = total
+        self.stream = stream or sys.stderr
+        self.succeeded = 0
+        self.failed = 0
+        self._start = time.monotonic()
+
+    def record(self, result):
+        if "error" in result:
+            self.failed += 1
+        else:
+            self.succeeded += 1
+        finished = self.succeeded + self.failed
+        elapsed = time.monotonic() - self._start
+        rate = finished / elapsed if elapsed > 0 else 0.0
+        print(f"{finished}/{self.total} finished, {self.failed} failed, {rate:.2f} consignments/s", file=self.stream)
+
+    def to_dict(self):
+        return {
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "seconds": time.monotonic() - self._start
+        }
+
+
+def reprocess(events, summary_path, concurrency=1, api_requests_per_second=0, progress_stream=None):
+    """Runs the events that have not already succeeded, appending each result to the summary."""
+    succeeded = read_succeeded(summary_path)
+    pending = [event for event in events if event["consignmentId"] not in succeeded]
+    progress = Progress(len(pending), progress_stream)
+    worker_rate = api_requests_per_second / max(concurrency, 1)
+    with open(summary_path, "a") as summary:
+        def record(result):
+            summary.write(f"{json.dumps(result)}\n")
+            summary.flush()
+            progress.record(result)
+
+        if concurrency <= 1:
+            with worker_environment(worker_rate):
+                for event in pending:
+                    record(process_event(event))
+        else:
+            with ProcessPoolExecutor(concurrency, initializer=configure_worker, initargs=(worker_rate,)) as executor:
+                futures = [executor.submit(process_event, event) for event in pending]
+                for future in as_completed(futures):
+                    record(future.result())
+    return {"skipped": len(events) - len(pending)} | progress.to_dict()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="File of consignment ids or JSON events, one per line, or - for stdin.")
+    parser.add_argument("--summary", required=True,
+                        help="JSON Lines file the result of each consignment is appended to.")
+    parser.add_argument("--concurrency", type=int, default=os.cpu_count() or 1, help="Number of worker processes.")
+    parser.add_argument("--api-rate", type=float, default=0,
+                        help="Most API requests per second across all workers. 0 means no limit.")
+    args = parser.parse_args(argv)
+
+    if args.input == "-":
+        events = list(read_events(sys.stdin))
+    else:
+        with open(args.input) as input_file:
+            events = list(read_events(input_file))
+    totals = reprocess(events, args.summary, args.concurrency, args.api_rate)
+    print(json.dumps(totals))
+    return 1 if totals["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""Benchmarks each stage of the lambda against synthetic consignments.
+
+Run from the repository root, for example:
+
+    python -m tests.benchmark --files 1000 100000 --metadata 3 20 --prefixes default sharepoint --output bench.json
+
+Each combination of file count, metadata count and prefix type is run once. Every stage is timed without
+tracing, then run again under tracemalloc for its peak memory. Both are written as JSON, along with the
+current commit, so runs from different commits can be compared. The source objects are put in moto so the
+upload check lists them, and the results are written to a stub S3 client so moto's storage is not counted.
+"""
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+from unittest.mock import patch
+
+import boto3
+from moto import mock_aws
+
+from src import lambda_handler
+from tests.utils.utils import DiscardingS3, configure_mock_urlopen, setup_env_vars, user_id, consignment_id
+
+PREFIX_TYPES = {
+    "default": f"{user_id}/{consignment_id}",
+    "sharepoint": "sharepoint/prefix",
+    "harddrive": "harddrive/prefix"
+}
+RESULT_METADATA = ["ClientSideOriginalFilepath", "SHA256ClientSideChecksum", "ClientSideFileSize"]
+
+
+def build_consignment(file_count, metadata_count, seed=0):
+    """Returns a getConsignment response with file_count files, each with at least metadata_count metadata rows."""
+    rng = random.Random(seed)
+    files = []
+    for index in range(file_count):
+        metadata = [
+            {"name": "ClientSideOriginalFilepath", "value": f"consignment/folder{index % 100}/file{index}.txt"},
+            {"name": "SHA256ClientSideChecksum", "value": f"{rng.getrandbits(256):064x}"},
+            {"name": "ClientSideFileSize", "value": str(rng.randint(0, 64))}
+        ]
+        metadata += [{"name": f"Property{extra}", "value": f"value{extra}"} for extra in range(metadata_count - 3)]
+        files.append({
+            "fileId": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "uploadMatchId": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "fileType": "File",
+            "fileMetadata": metadata
+        })
+    return {"data": {"getConsignment": {"consignmentType": "standard", "userid": user_id, "files": files}}}
+
+
+def measure(stage, func, *args):
+    """Runs func twice: once timed without tracing, then again under tracemalloc for its peak memory.
+
+    Tracing slows allocation-heavy stages down a lot, so it would distort the timings.
+    The result of the timed run is returned.
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {"stage": stage, "seconds": seconds, "peakBytes": peak}
+
+
+def run_benchmark(file_count, metadata_count, prefix_type):
+    prefix = PREFIX_TYPES[prefix_type]
+    payload = json.dumps(build_consignment(file_count, metadata_count)).encode("utf-8")
+    stages = []
+
+    def record(stage, func, *args):
+        result, timings = measure(stage, func, *args)
+        stages.append(timings)
+        return result
+
+    with mock_aws(), patch('src.lambda_handler.session_urlopen') as mock_url_open, \
+            patch.object(lambda_handler.credential_cache, 'get_access_token', return_value='ABCD'):
+        setup_env_vars()
+        lambda_handler.reset_clients()
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test-bucket', CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+
+        def parse_response(query):
+            # Every stage runs twice, so the mocked API is given a fresh response each time
+            configure_mock_urlopen(mock_url_open, payload)
+            return lambda_handler.call_api(query)
+
+        query = record("getQuery", lambda_handler.get_query, consignment_id)
+        data = record("parseResponse", parse_response, query)
+        consignment = data['data']['getConsignment']
+        for file in consignment['files']:
+            s3.put_object(
+                Body=b"x" * lambda_handler.get_file_size(file),
+                Bucket='test-bucket',
+                Key=f"{prefix}/{lambda_handler.get_object_identifier(prefix, file)}"
+            )
+        record("validateAllFilesUploaded", lambda_handler.validate_all_files_uploaded,
+               'test-bucket', prefix, consignment)
+        results = record("buildResults", lambda consignment_files: [
+            lambda_handler.process_file_json('test-bucket', prefix, file) |
+            {'consignmentType': consignment['consignmentType'], 'consignmentId': consignment_id, 'userId': user_id}
+            for file in consignment_files
+        ], consignment['files'])
+        # moto keeps every uploaded object in memory, so the writer uploads to a stub to measure its own peak
+        with patch.object(lambda_handler.clients, 'client', return_value=DiscardingS3()):
+            record("writeResultsJson", lambda: lambda_handler.write_results_json(
+                lambda_handler.iter_json({"results": iter(results)}), consignment_id
+            ))
+        lambda_handler.reset_clients()
+
+    return {
+        "files": file_count,
+        "metadata": metadata_count,
+        "prefix": prefix_type,
+        "responseBytes": len(payload),
+        "stages": stages
+    }
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--metadata", type=int, nargs="+", default=[3, 20])
+    parser.add_argument("--prefixes", nargs="+", choices=sorted(PREFIX_TYPES), default=sorted(PREFIX_TYPES))
+    parser.add_argument("--output", help="File to write the results to. Defaults to stdout.")
+    args = parser.parse_args(argv)
+
+    runs = [
+        run_benchmark(file_count, max(metadata_count, len(RESULT_METADATA)), prefix_type)
+        for file_count in args.files
+        for metadata_count in args.metadata
+        for prefix_type in args.prefixes
+    ]
+    report = json.dumps({"commit": current_commit(), "python": sys.version.split()[0], "runs": runs}, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,27 @@
+import logging
+import subprocess
+import sys
 import urllib
-from unittest.mock import patch
+import uuid
+from unittest.mock import MagicMock, patch
 
 import boto3
 import pytest
 from moto import mock_aws
 
-from src import lambda_handler
+from src import lambda_handler, reprocess
 from src.lambda_handler import File
 from tests.utils.utils import *
 from sgqlc.types import Field
 
 
+@pytest.fixture(autouse=True)
+def reset_warm_state():
+    lambda_handler.credential_cache.clear()
+    lambda_handler.reset_clients()
+    lambda_handler.set_deadline(None)
+
+
 @pytest.fixture(scope='function')
 def ssm():
     with mock_aws():
@@ -64,14 +75,14 @@ def test_get_object_identifier_returns_match_id_for_networkdrive_prefix():
     assert res == "matchId1"
 
 
-@patch('urllib.request.urlopen')
+@patch('src.lambda_handler.session_urlopen')
 def test_files_are_returned(mock_url_open, ssm, s3):
     setup_env_vars()
     setup_ssm(ssm)
     setup_s3(s3)
     configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
     event = {'consignmentId': consignment_id}
-    with patch('src.lambda_handler.requests.post') as mock_post:
+    with patch('requests.Session.post') as mock_post:
         mock_post.return_value.status_code = 200
         mock_post.return_value.json = access_token
         lambda_handler.handler(event, None)
@@ -96,7 +107,7 @@ def test_files_are_returned(mock_url_open, ssm, s3):
         validate_statuses_response(response)
 
 
-@patch('urllib.request.urlopen')
+@patch('src.lambda_handler.session_urlopen')
 def test_files_are_returned_with_s3_source_overrides_sharepoint(mock_url_open, ssm, s3):
     setup_env_vars()
     setup_ssm(ssm)
@@ -105,7 +116,7 @@ def test_files_are_returned_with_s3_source_overrides_sharepoint(mock_url_open, s
     setup_s3(s3, bucket=override_bucket, prefix=f'{override_key_prefix}/')
     configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
     event_with_s3_overrides = {'consignmentId': consignment_id, "s3SourceBucket": override_bucket, "s3SourceBucketPrefix": override_key_prefix}
-    with patch('src.lambda_handler.requests.post') as mock_post:
+    with patch('requests.Session.post') as mock_post:
         mock_post.return_value.status_code = 200
         mock_post.return_value.json = access_token
         lambda_handler.handler(event_with_s3_overrides, None)
@@ -130,7 +141,7 @@ def test_files_are_returned_with_s3_source_overrides_sharepoint(mock_url_open, s
         validate_statuses_response(response)
 
 
-@patch('urllib.request.urlopen')
+@patch('src.lambda_handler.session_urlopen')
 def test_files_are_returned_with_s3_source_overrides_harddrive(mock_url_open, ssm, s3):
     setup_env_vars()
     setup_ssm(ssm)
@@ -139,7 +150,7 @@ def test_files_are_returned_with_s3_source_overrides_harddrive(mock_url_open, ss
     setup_s3(s3, bucket=override_bucket, prefix=f'{override_key_prefix}/')
     configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
     event_with_s3_overrides = {'consignmentId': consignment_id, "s3SourceBucket": override_bucket, "s3SourceBucketPrefix": override_key_prefix}
-    with patch('src.lambda_handler.requests.post') as mock_post:
+    with patch('requests.Session.post') as mock_post:
         mock_post.return_value.status_code = 200
         mock_post.return_value.json = access_token
         lambda_handler.handler(event_with_s3_overrides, None)
@@ -164,7 +175,7 @@ def test_files_are_returned_with_s3_source_overrides_harddrive(mock_url_open, ss
         validate_statuses_response(response)
 
 
-@patch('urllib.request.urlopen')
+@patch('src.lambda_handler.session_urlopen')
 def test_error_from_graphql_api(mock_url_open, ssm, s3):
     setup_env_vars()
     setup_ssm(ssm)
@@ -178,7 +189,7 @@ def test_error_from_graphql_api(mock_url_open, ssm, s3):
     )
     event = {'consignmentId': consignment_id}
     configure_mock_urlopen(mock_url_open, err)
-    with patch('src.lambda_handler.requests.post') as mock_post:
+    with patch('requests.Session.post') as mock_post:
         mock_post.return_value.status_code = 200
         mock_post.return_value.json = access_token
         with pytest.raises(Exception) as ex:
@@ -191,20 +202,20 @@ def test_error_from_keycloak(ssm, s3):
     setup_ssm(ssm)
     setup_s3(s3)
     event = {'consignmentId': consignment_id}
-    with patch('src.lambda_handler.requests.post') as mock_post:
+    with patch('requests.Session.post') as mock_post:
         mock_post.return_value.status_code = 500
         with pytest.raises(RuntimeError) as ex:
             lambda_handler.handler(event, None)
         assert ex.value.args[0] == 'Non 200 status from Keycloak 500'
 
 
-@patch('urllib.request.urlopen')
+@patch('src.lambda_handler.session_urlopen')
 def test_error_if_s3_download_error(mock_url_open, ssm, s3):
     setup_env_vars()
     setup_ssm(ssm)
     event = {'consignmentId': consignment_id}
     configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
-    with patch('src.lambda_handler.requests.post') as mock_post:
+    with patch('requests.Session.post') as mock_post:
         mock_post.return_value.status_code = 200
         mock_post.return_value.json = access_token
         with pytest.raises(s3.exceptions.NoSuchBucket) as ex:
@@ -213,16 +224,1055 @@ def test_error_if_s3_download_error(mock_url_open, ssm, s3):
         assert ex.value.response['Error']['Message'] == 'The specified bucket does not exist'
 
 
-@patch('urllib.request.urlopen')
+@patch('src.lambda_handler.session_urlopen')
 def test_error_if_s3_files_mismatch(mock_url_open, ssm, s3):
     setup_env_vars()
     setup_ssm(ssm)
     setup_s3(s3, missing_file_id)
     event = {'consignmentId': consignment_id}
     configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
-    with patch('src.lambda_handler.requests.post') as mock_post:
+    with patch('requests.Session.post') as mock_post:
         mock_post.return_value.status_code = 200
         mock_post.return_value.json = access_token
         with pytest.raises(RuntimeError) as ex:
             lambda_handler.handler(event, None)
         assert ex.value.args[0] == f'Uploaded files do not match files from the API for {user_id}/{consignment_id}'
+
+
+def test_iter_json_matches_json_dumps():
+    document = {
+        "results": ({"fileId": file_id, "fileCheckResults": {"antivirus": []}} for file_id in all_file_ids),
+        "statuses": {"statuses": [{"id": consignment_id, "overwrite": False}]},
+        "empty": iter([]),
+        "redactedResults": {}
+    }
+    expected = {
+        "results": [{"fileId": file_id, "fileCheckResults": {"antivirus": []}} for file_id in all_file_ids],
+        "statuses": {"statuses": [{"id": consignment_id, "overwrite": False}]},
+        "empty": [],
+        "redactedResults": {}
+    }
+    assert "".join(lambda_handler.iter_json(document)) == json.dumps(expected)
+
+
+@patch.dict(os.environ, {"RESULTS_PART_SIZE_BYTES": "256"})
+@patch('moto.s3.models.S3_UPLOAD_PART_MIN_SIZE', 256)
+@patch('src.lambda_handler.MIN_PART_SIZE', 256)
+def test_write_results_json_uses_multipart_upload_for_large_payloads(s3):
+    setup_env_vars()
+    setup_s3(s3)
+    chunks = [json.dumps({"fileId": f"{index}"}) for index in range(100)]
+    bucket_info = lambda_handler.write_results_json(iter(chunks), consignment_id)
+    obj = s3.get_object(Bucket=bucket_info["bucket"], Key=bucket_info["key"])
+    assert obj['Body'].read().decode("utf-8") == "".join(chunks)
+    assert obj['ETag'].strip('"').endswith(f"-{len(''.join(chunks)) // 256 + 1}")
+
+
+def test_write_results_json_aborts_upload_on_error(s3):
+    setup_env_vars()
+    setup_s3(s3)
+
+    def failing_chunks():
+        yield "x" * 10
+        raise RuntimeError("Failed to build results")
+
+    with patch('src.lambda_handler.get_results_part_size', return_value=4):
+        with pytest.raises(RuntimeError):
+            lambda_handler.write_results_json(failing_chunks(), consignment_id)
+    assert s3.list_multipart_uploads(Bucket='test-backend-checks-bucket').get('Uploads', []) == []
+    assert 'Contents' not in s3.list_objects(Bucket='test-backend-checks-bucket')
+
+
+@patch.dict(os.environ, {"RESULTS_PART_SIZE_BYTES": "256", "RESULTS_COMPRESSION": "gzip"})
+@patch('moto.s3.models.S3_UPLOAD_PART_MIN_SIZE', 256)
+@patch('src.lambda_handler.MIN_PART_SIZE', 256)
+def test_write_results_json_compresses_results(s3):
+    setup_env_vars()
+    setup_s3(s3)
+    document = {"results": [{"fileId": str(uuid.UUID(int=index))} for index in range(200)]}
+    bucket_info = lambda_handler.write_results_json(lambda_handler.iter_json(document), consignment_id)
+    obj = s3.head_object(Bucket=bucket_info["bucket"], Key=bucket_info["key"])
+    assert bucket_info["key"].endswith("/results.json.gz")
+    assert obj["ContentEncoding"] == "gzip"
+    assert obj["ContentType"] == "application/json"
+    assert obj["ContentLength"] < len(json.dumps(document))
+    assert lambda_handler.read_results(bucket_info["bucket"], bucket_info["key"], s3) == document
+
+
+def test_read_results_loads_uncompressed_results(s3):
+    setup_env_vars()
+    setup_s3(s3)
+    bucket_info = lambda_handler.write_results_json(json.dumps({"results": []}), consignment_id)
+    assert "ContentEncoding" not in s3.head_object(Bucket=bucket_info["bucket"], Key=bucket_info["key"])
+    assert lambda_handler.read_results(bucket_info["bucket"], bucket_info["key"], s3) == {"results": []}
+
+
+@patch.dict(os.environ, {"RESULTS_COMPRESSION": "gzip"})
+@patch('src.lambda_handler.session_urlopen')
+def test_compressed_results_are_reused_on_retry(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+        first = lambda_handler.handler(event, None)
+        configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+        second = lambda_handler.handler(event, None)
+    assert first == second
+    assert first["key"].endswith("/results.json.gz")
+    assert len(get_result_from_s3(s3, consignment_id)["results"]) == 2
+
+
+def test_duplicate_grouper_groups_by_checksum_and_size():
+    def file(file_id, checksum, size, file_type="File"):
+        metadata = [
+            {"name": "SHA256ClientSideChecksum", "value": checksum},
+            {"name": "ClientSideFileSize", "value": size}
+        ]
+        return {"fileId": file_id, "fileType": file_type, "fileMetadata": metadata}
+
+    files = [file("1", "a", "1"), file("2", "a", "2"), file("3", "a", "1"), file("4", "b", "1"), file("5", "a", "1"),
+             file("6", "a", "1", "Folder")]
+    grouper = lambda_handler.DuplicateGrouper()
+    assert [file["fileId"] for file in grouper.representatives(files)] == ["1", "2", "4", "6"]
+    assert grouper.duplicates == {"1": ["3", "5"]}
+
+
+@pytest.mark.parametrize("results_format", ["json", "jsonl", "compact"])
+@patch('src.lambda_handler.session_urlopen')
+def test_duplicate_files_are_emitted_once_with_a_mapping(mock_url_open, ssm, s3, results_format):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post, \
+            patch.dict(os.environ, {"DEDUPLICATE_RESULTS": "true", "RESULTS_FORMAT": results_format}):
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        bucket_info = lambda_handler.handler(event, None)
+    document = lambda_handler.read_results(bucket_info["bucket"], bucket_info["key"], s3)
+    assert document["duplicateFiles"] == {file_two_id: [file_one_id]}
+    if results_format == "jsonl":
+        assert document["resultCount"] == 1
+    else:
+        assert [result["fileId"] for result in lambda_handler.expand_results(document)["results"]] == [file_two_id]
+
+
+def sized_file(file_id, size, file_type="File"):
+    return {"fileId": file_id, "fileType": file_type, "fileMetadata": [{"name": "ClientSideFileSize", "value": size}]}
+
+
+def test_balance_files_packs_largest_first_into_the_lightest_batch():
+    files = [sized_file(str(size), str(size)) for size in [1, 7, 3, 5, 2, 4, 6]] + [sized_file("folder", "0", "Folder")]
+    ordered, batches = lambda_handler.balance_files(files, batch_count=2)
+    assert [file["fileId"] for file in ordered] == ["7", "4", "3", "6", "5", "2", "1"]
+    assert batches == [
+        {"firstResult": 0, "resultCount": 3, "bytes": 14},
+        {"firstResult": 3, "resultCount": 4, "bytes": 14}
+    ]
+
+
+def test_balance_files_uses_enough_batches_for_the_target_size():
+    files = [sized_file(str(index), "10") for index in range(5)] + [sized_file("large", "100")]
+    _, batches = lambda_handler.balance_files(files, batch_count=1, target_bytes=50)
+    assert [batch["bytes"] for batch in batches] == [100, 30, 20]
+    _, batches = lambda_handler.balance_files(files[:2], target_bytes=1)
+    assert len(batches) == 2
+
+
+@patch.dict(os.environ, {"RESULTS_BATCH_COUNT": "2"})
+@patch('src.lambda_handler.session_urlopen')
+def test_results_are_written_in_balanced_batches(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        lambda_handler.handler(event, None)
+    response = get_result_from_s3(s3, consignment_id)
+    assert [result["fileId"] for result in response["results"]] == [file_two_id, file_one_id]
+    assert response["batches"] == [
+        {"firstResult": 0, "resultCount": 1, "bytes": 12},
+        {"firstResult": 1, "resultCount": 1, "bytes": 12}
+    ]
+
+
+def test_multipart_upload_is_aborted_when_it_cannot_be_completed():
+    s3 = MagicMock()
+    s3.create_multipart_upload.return_value = {"UploadId": "upload"}
+    s3.upload_part.return_value = {"ETag": "etag"}
+    s3.complete_multipart_upload.side_effect = RuntimeError("Failed to complete")
+    writer = lambda_handler.S3MultipartWriter(s3, "bucket", "key", part_size=4)
+    with pytest.raises(RuntimeError):
+        with writer:
+            writer.write(b"123456")
+    s3.abort_multipart_upload.assert_called_once_with(Bucket="bucket", Key="key", UploadId="upload")
+
+
+def test_multipart_writer_holds_about_one_part_in_memory():
+    import tracemalloc
+    part_size = 1024 * 1024
+    s3 = DiscardingS3()
+    chunk = b"x" * (part_size // 4)
+    tracemalloc.start()
+    try:
+        with lambda_handler.S3MultipartWriter(s3, "bucket", "key", part_size) as writer:
+            for _ in range(12):
+                writer.write(chunk)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert s3.uploaded_bytes == [part_size] * 3
+    assert peak < 2.5 * part_size
+
+
+@patch.dict(os.environ, {"FILES_PAGE_SIZE": "1"})
+@patch('src.lambda_handler.session_urlopen')
+def test_files_are_returned_a_page_at_a_time(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    configure_mock_urlopen_pages(mock_url_open, [graphql_ok_paginated_page_one, graphql_ok_paginated_page_two])
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        lambda_handler.handler(event, None)
+    assert mock_url_open.call_count == 2
+    second_query = json.loads(mock_url_open.call_args_list[1].args[0].data)["query"]
+    assert f'currentCursor: "{file_two_id}"' in second_query
+    response = get_result_from_s3(s3, consignment_id)
+    results = response["results"]
+    assert [result["fileId"] for result in results] == [file_two_id, file_one_id]
+    assert results[1]["originalPath"] == "testfile/subfolder/subfolder2.txt"
+    assert results[1]["s3SourceBucketKey"] == f"{user_id}/{consignment_id}/{file_one_id}"
+    validate_statuses_response(response)
+
+
+@patch.dict(os.environ, {"FILES_PAGE_SIZE": "1"})
+@patch('src.lambda_handler.session_urlopen')
+def test_error_if_s3_files_mismatch_a_page_at_a_time(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3, missing_file_id)
+    configure_mock_urlopen_pages(mock_url_open, [graphql_ok_paginated_page_one, graphql_ok_paginated_page_two])
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        with pytest.raises(RuntimeError) as ex:
+            lambda_handler.handler(event, None)
+        assert ex.value.args[0] == f'Uploaded files do not match files from the API for {user_id}/{consignment_id}'
+    assert 'Contents' not in s3.list_objects(Bucket='test-backend-checks-bucket')
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_stage_timings_are_logged_when_s3_listing_runs_concurrently(mock_url_open, ssm, s3, caplog):
+    setup_env_vars()
+    setup_ssm(ssm)
+    override_bucket = 'override-bucket'
+    override_key_prefix = 'sharepoint/prefix'
+    setup_s3(s3, bucket=override_bucket, prefix=f'{override_key_prefix}/')
+    configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+    event = {
+        'consignmentId': consignment_id,
+        "s3SourceBucket": override_bucket,
+        "s3SourceBucketPrefix": override_key_prefix
+    }
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        with caplog.at_level(logging.INFO):
+            lambda_handler.handler(event, None)
+    timings = [json.loads(record.message) for record in caplog.records if '"stages"' in record.message][0]
+    assert timings["consignmentId"] == consignment_id
+    assert set(timings["stages"]) == {"clientSecret", "token", "graphql", "s3List"}
+    assert "savedSeconds" in timings["stages"]["s3List"]
+    assert "savedSeconds" in timings["stages"]["clientSecret"]
+    assert timings["savedSeconds"] >= 0
+
+
+def expiring_access_token(expires_in):
+    return lambda: {'access_token': 'ABCD', 'expires_in': expires_in}
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_credentials_are_reused_by_warm_invocations(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post, \
+            patch('src.lambda_handler.get_client_secret', return_value="client-secret") as mock_secret:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = expiring_access_token(300)
+        for _ in range(2):
+            configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+            lambda_handler.handler(event, None)
+        assert mock_secret.call_count == 1
+        assert mock_post.call_count == 1
+
+
+@patch.dict(os.environ, {"TOKEN_EXPIRY_MARGIN_SECONDS": "30"})
+def test_token_is_refreshed_when_close_to_expiry(ssm):
+    setup_env_vars()
+    setup_ssm(ssm)
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = expiring_access_token(20)
+        lambda_handler.credential_cache.get_access_token()
+        lambda_handler.credential_cache.get_access_token()
+        assert mock_post.call_count == 2
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_token_is_refreshed_when_api_returns_unauthorised(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    unauthorised = urllib.error.HTTPError('http://testserver.com', 401, 'Unauthorized', {}, io.BytesIO(b''))
+    ok_response = io.BytesIO(graphql_ok_multiple_files)
+    ok_response.headers = {'Content-Type': 'application/json'}
+    mock_url_open.side_effect = [unauthorised, ok_response]
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = expiring_access_token(300)
+        lambda_handler.handler(event, None)
+        assert mock_post.call_count == 2
+    assert len(get_result_from_s3(s3, consignment_id)["results"]) == 2
+
+
+def test_keycloak_server_error_is_retried_with_timeouts(ssm):
+    setup_env_vars()
+    setup_ssm(ssm)
+    unavailable = MagicMock(status_code=503)
+    ok = MagicMock(status_code=200, json=access_token)
+    with patch('requests.Session.post', side_effect=[unavailable, ok]) as mock_post, \
+            patch.dict(os.environ, {"CONNECT_TIMEOUT_SECONDS": "2", "AUTH_READ_TIMEOUT_SECONDS": "7"}):
+        assert lambda_handler.credential_cache.get_access_token() == 'ABCD'
+    assert mock_post.call_count == 2
+    assert mock_post.call_args.kwargs["timeout"] == (2.0, 7.0)
+
+
+def test_keycloak_error_is_raised_once_attempts_are_used_up(ssm):
+    setup_env_vars()
+    setup_ssm(ssm)
+    with patch('requests.Session.post') as mock_post, patch.dict(os.environ, {"HTTP_MAX_ATTEMPTS": "2"}):
+        mock_post.return_value.status_code = 502
+        with pytest.raises(RuntimeError) as ex:
+            lambda_handler.credential_cache.get_access_token()
+    assert ex.value.args[0] == 'Non 200 status from Keycloak 502'
+    assert mock_post.call_count == 2
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_api_server_errors_and_timeouts_are_retried(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    bad_gateway = urllib.error.HTTPError('http://testserver.com', 502, 'Bad Gateway', {}, io.BytesIO(b''))
+    configure_mock_urlopen_pages(mock_url_open, [bad_gateway, TimeoutError("timed out"), graphql_ok_multiple_files])
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post, patch.dict(os.environ, {"API_READ_TIMEOUT_SECONDS": "60"}):
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        lambda_handler.handler(event, None)
+    assert mock_url_open.call_count == 3
+    assert mock_url_open.call_args.kwargs["timeout"] == (5.0, 60.0)
+    assert len(get_result_from_s3(s3, consignment_id)["results"]) == 2
+
+
+def json_http_error(status, body):
+    return urllib.error.HTTPError('http://testserver.com', status, 'Error', {'Content-Type': 'application/json'},
+                                  io.BytesIO(json.dumps(body).encode("utf-8")))
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_api_server_errors_with_json_bodies_are_retried(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    unavailable = json_http_error(503, {"errors": [{"message": "Service Unavailable"}]})
+    configure_mock_urlopen_pages(mock_url_open, [unavailable, graphql_ok_multiple_files])
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        lambda_handler.handler(event, None)
+    assert mock_url_open.call_count == 2
+    assert not lambda_handler.clients.projected_query_rejected
+    assert 'fileFiltersInput' in json.loads(mock_url_open.call_args.args[0].data)["query"]
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_api_retries_stop_at_the_deadline(mock_url_open, ssm):
+    setup_env_vars()
+    setup_ssm(ssm)
+    configure_mock_urlopen(mock_url_open, TimeoutError("timed out"))
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 12000
+    with patch.dict(os.environ, {"HTTP_BACKOFF_BASE_SECONDS": "5", "DEADLINE_MARGIN_SECONDS": "10"}), \
+            patch.object(lambda_handler.credential_cache, 'get_access_token', return_value='ABCD'), \
+            patch('random.uniform', return_value=5):
+        lambda_handler.set_deadline(context)
+        with pytest.raises(TimeoutError):
+            lambda_handler.call_api(lambda_handler.get_query(consignment_id))
+    assert mock_url_open.call_count == 1
+    assert mock_url_open.call_args.kwargs["timeout"][1] <= 2
+
+
+def test_no_request_is_made_after_the_deadline(ssm):
+    setup_env_vars()
+    setup_ssm(ssm)
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 5000
+    with patch('requests.Session.post') as mock_post:
+        lambda_handler.set_deadline(context)
+        with pytest.raises(lambda_handler.DeadlineExceededError):
+            lambda_handler.credential_cache.get_access_token()
+    mock_post.assert_not_called()
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_token_is_refreshed_when_api_returns_unauthorised_json(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    unauthorised = json_http_error(401, {"errors": [{"message": "Unauthorized"}]})
+    configure_mock_urlopen_pages(mock_url_open, [unauthorised, graphql_ok_multiple_files])
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = expiring_access_token(300)
+        lambda_handler.handler(event, None)
+        assert mock_post.call_count == 2
+    assert len(get_result_from_s3(s3, consignment_id)["results"]) == 2
+
+
+def session_response(status_code, content, content_type='application/json', **headers):
+    return MagicMock(status_code=status_code, reason='Reason', content=content,
+                     headers={'Content-Type': content_type} | headers)
+
+
+def test_api_requests_use_the_pooled_session(ssm):
+    import requests
+    setup_env_vars()
+    setup_ssm(ssm)
+    session = lambda_handler.clients.http_session()
+    responses = [
+        requests.exceptions.ConnectTimeout("timed out"),
+        session_response(503, b'{"errors": [{"message": "Service Unavailable"}]}'),
+        session_response(200, graphql_ok_multiple_files, **{'Content-Encoding': 'gzip'}),
+        session_response(200, graphql_ok_multiple_files)
+    ]
+    query = lambda_handler.get_query(consignment_id)
+    with patch.object(lambda_handler.credential_cache, 'get_access_token', return_value='ABCD'), \
+            patch.object(session, 'request', side_effect=responses) as mock_request:
+        first = lambda_handler.call_api(query)
+        second = lambda_handler.call_api(query)
+    assert first["data"] == second["data"] == json.loads(graphql_ok_multiple_files)["data"]
+    assert mock_request.call_count == 4
+    method, url = mock_request.call_args.args
+    assert (method, url) == ("POST", "http://localhost")
+    assert mock_request.call_args.kwargs["headers"]["Authorization"] == "Bearer ABCD"
+    assert mock_request.call_args.kwargs["timeout"] == (5.0, 300.0)
+
+
+def test_clients_are_reused_until_reset(s3):
+    setup_env_vars()
+    s3_client = lambda_handler.clients.client("s3")
+    session = lambda_handler.clients.http_session()
+    endpoint = lambda_handler.clients.graphql_endpoint("http://localhost")
+    assert lambda_handler.clients.client("s3") is s3_client
+    assert lambda_handler.clients.http_session() is session
+    assert lambda_handler.clients.graphql_endpoint("http://localhost") is endpoint
+    lambda_handler.reset_clients()
+    assert lambda_handler.clients.client("s3") is not s3_client
+    assert lambda_handler.clients.http_session() is not session
+    assert lambda_handler.clients.graphql_endpoint("http://localhost") is not endpoint
+
+
+def test_process_file_json_matches_process_file():
+    data = json.loads(graphql_ok_multiple_files)
+    data["data"]["getConsignment"]["files"][0]["fileMetadata"] += [
+        {"name": "FileReference", "value": "ref"},
+        {"name": "ClientSideOriginalFilepath", "value": "duplicate/path.txt"}
+    ]
+    query = lambda_handler.get_query(consignment_id)
+    consignment = (query + data).getConsignment
+    for prefix in ["default/prefix", "sharepoint/prefix"]:
+        for file, file_json in zip(consignment.files, data["data"]["getConsignment"]["files"]):
+            expected = json.dumps(lambda_handler.process_file("test-bucket", prefix, file))
+            actual = json.dumps(lambda_handler.process_file_json("test-bucket", prefix, file_json))
+            assert actual == expected
+
+
+def test_reconcile_files_reports_missing_and_extra_files():
+    report = lambda_handler.reconcile_files([file_one_id, file_two_id, "missing"], [file_one_id, "extra1", "extra2"])
+    assert not report.matched
+    assert report.to_dict() == {
+        "missingCount": 2,
+        "extraCount": 2,
+        "sizeMismatchCount": 0,
+        "missingSample": [file_two_id, "missing"],
+        "extraSample": ["extra1", "extra2"],
+        "sizeMismatchSample": [],
+        "stoppedEarly": False
+    }
+
+
+def test_reconcile_files_matches_regardless_of_order():
+    report = lambda_handler.reconcile_files(all_file_ids, list(reversed(all_file_ids)))
+    assert report.matched
+
+
+@patch.dict(os.environ, {"RECONCILIATION_MAX_MISMATCHES": "2", "RECONCILIATION_SAMPLE_SIZE": "1"})
+def test_reconcile_files_stops_early_at_mismatch_threshold():
+    consumed = []
+
+    def api_files():
+        for identifier in ["a", "b", "c", "d"]:
+            consumed.append(identifier)
+            yield identifier
+
+    report = lambda_handler.reconcile_files(api_files(), [])
+    assert consumed == ["a", "b"]
+    assert report.to_dict() == {
+        "missingCount": 2,
+        "extraCount": None,
+        "sizeMismatchCount": 0,
+        "missingSample": ["a"],
+        "extraSample": [],
+        "sizeMismatchSample": [],
+        "stoppedEarly": True
+    }
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_mismatch_error_includes_reconciliation_report(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    s3.delete_object(Bucket="test-bucket", Key=f"{user_id}/{consignment_id}/{file_one_id}")
+    s3.put_object(Body=b'filetoupload', Bucket="test-bucket", Key=f"{user_id}/{consignment_id}/unexpected")
+    event = {'consignmentId': consignment_id}
+    configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        with pytest.raises(lambda_handler.UploadMismatchError) as ex:
+            lambda_handler.handler(event, None)
+    assert ex.value.args[1]["missingSample"] == [file_one_id]
+    assert ex.value.args[1]["extraSample"] == ["unexpected"]
+    assert "unexpected" in str(ex.value)
+
+
+@patch.dict(os.environ, {"S3_LIST_CONCURRENCY": "4"})
+@patch('src.lambda_handler.S3_LIST_PAGE_SIZE', 2)
+def test_s3_list_files_lists_uuid_prefixes_in_parallel(s3):
+    setup_env_vars()
+    setup_s3(s3)
+    file_ids = all_file_ids + [str(uuid.uuid4()) for _ in range(5)]
+    for file_id in file_ids[2:]:
+        s3.put_object(Body=b'filetoupload', Bucket='test-bucket', Key=f"{user_id}/{consignment_id}/{file_id}")
+    listed_prefixes = []
+    list_objects = lambda_handler.clients.client("s3").list_objects_v2
+
+    def record_prefix(**kwargs):
+        listed_prefixes.append(kwargs["Prefix"])
+        return list_objects(**kwargs)
+
+    with patch.object(lambda_handler.clients.client("s3"), 'list_objects_v2', side_effect=record_prefix):
+        names = lambda_handler.s3_list_files('test-bucket', f"{user_id}/{consignment_id}")
+    assert sorted(names) == sorted(file_ids)
+    assert f"{user_id}/{consignment_id}/a" in listed_prefixes
+
+
+@patch.dict(os.environ, {"S3_LIST_CONCURRENCY": "4"})
+@patch('src.lambda_handler.S3_LIST_PAGE_SIZE', 2)
+def test_sharded_s3_listing_includes_names_outside_the_shards(s3):
+    setup_env_vars()
+    setup_s3(s3)
+    stray_names = ["A1B2C3D4-0000-4000-8000-000000000000", "_underscore", "zz-unexpected"]
+    for name in stray_names:
+        s3.put_object(Body=b'filetoupload', Bucket='test-bucket', Key=f"{user_id}/{consignment_id}/{name}")
+    sizes = lambda_handler.s3_list_file_sizes('test-bucket', f"{user_id}/{consignment_id}")
+    assert sorted(sizes) == sorted(all_file_ids + stray_names)
+    report = lambda_handler.reconcile_files(all_file_ids, sizes)
+    assert not report.matched
+    assert report.extra_count == len(stray_names)
+
+
+@patch.dict(os.environ, {"S3_LIST_CONCURRENCY": "4"})
+@patch('src.lambda_handler.S3_LIST_PAGE_SIZE', 1)
+def test_s3_list_files_falls_back_to_serial_listing_for_non_uuid_names(s3):
+    setup_env_vars()
+    setup_s3(s3, prefix='sharepoint/prefix/')
+    listed_prefixes = []
+    list_objects = lambda_handler.clients.client("s3").list_objects_v2
+
+    def record_prefix(**kwargs):
+        listed_prefixes.append(kwargs["Prefix"])
+        return list_objects(**kwargs)
+
+    with patch.object(lambda_handler.clients.client("s3"), 'list_objects_v2', side_effect=record_prefix):
+        names = lambda_handler.s3_list_files('test-bucket', 'sharepoint/prefix')
+    assert sorted(names) == sorted(all_match_ids)
+    assert set(listed_prefixes) == {'sharepoint/prefix'}
+
+
+@patch.dict(os.environ, {"RESULTS_FORMAT": "jsonl", "RESULTS_SHARD_MAX_BYTES": "1"})
+@patch('src.lambda_handler.session_urlopen')
+def test_results_are_written_as_json_lines_shards_with_a_manifest(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        bucket_info = lambda_handler.handler(event, None)
+    assert bucket_info["key"].endswith("/manifest.json")
+    manifest = json.loads(s3.get_object(Bucket=bucket_info["bucket"], Key=bucket_info["key"])['Body'].read())
+    assert manifest["resultsFormat"] == "jsonl"
+    assert manifest["resultCount"] == 2
+    assert [shard["resultCount"] for shard in manifest["shards"]] == [1, 1]
+    validate_statuses_response(manifest)
+    results = []
+    for shard in manifest["shards"]:
+        body = s3.get_object(Bucket=shard["bucket"], Key=shard["key"])['Body'].read()
+        assert len(body) == shard["bytes"]
+        results += [json.loads(line) for line in body.decode("utf-8").splitlines()]
+    assert [result["fileId"] for result in results] == [file_two_id, file_one_id]
+    assert results[1]["s3SourceBucketKey"] == f"{user_id}/{consignment_id}/{file_one_id}"
+
+
+def test_sharded_writer_removes_finished_shards_on_error(s3):
+    setup_env_vars()
+    setup_s3(s3)
+    with pytest.raises(RuntimeError):
+        writer = lambda_handler.ShardedJsonLinesWriter(s3, 'test-backend-checks-bucket', consignment_id, max_bytes=1)
+        with writer:
+            writer.write({"fileId": file_one_id})
+            writer.write({"fileId": file_two_id})
+            raise RuntimeError("Failed to build results")
+    assert 'Contents' not in s3.list_objects(Bucket='test-backend-checks-bucket')
+
+
+def test_benchmark_reports_every_stage():
+    from tests.benchmark import run_benchmark
+    run = run_benchmark(10, 5, "sharepoint")
+    assert run["files"] == 10
+    assert [stage["stage"] for stage in run["stages"]] == [
+        "getQuery", "parseResponse", "validateAllFilesUploaded", "buildResults", "writeResultsJson"
+    ]
+    assert all(stage["seconds"] >= 0 and stage["peakBytes"] > 0 for stage in run["stages"])
+
+
+def emf_lines(output):
+    return [json.loads(line) for line in output.splitlines() if line.startswith('{"_aws"')]
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_metrics_are_printed_in_embedded_metric_format(mock_url_open, ssm, s3, capsys):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        lambda_handler.handler(event, None)
+    [metrics] = emf_lines(capsys.readouterr().out)
+    definitions = {metric["Name"]: metric["Unit"] for metric in metrics["_aws"]["CloudWatchMetrics"][0]["Metrics"]}
+    assert metrics["consignmentId"] == consignment_id
+    assert metrics["fileCount"] == 2
+    assert metrics["listedKeys"] == 2
+    assert metrics["responseBytes"] == len(graphql_ok_multiple_files)
+    assert metrics["resultBytes"] == len(json.dumps(get_result_from_s3(s3, consignment_id)))
+    assert definitions["responseBytes"] == "Bytes"
+    for stage in ["clientSecret", "token", "graphql", "s3List", "reconcile", "writeResults", "s3Put"]:
+        assert definitions[f"{stage}Duration"] == "Milliseconds"
+        assert metrics[f"{stage}Duration"] >= 0
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_metrics_level_and_sampling_are_configurable(mock_url_open, ssm, s3, capsys):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        for environment, expected_lines in [
+            ({"METRICS_LEVEL": "counters"}, 1),
+            ({"METRICS_LEVEL": "none"}, 0),
+            ({"METRICS_SAMPLE_RATE": "0"}, 0)
+        ]:
+            configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+            with patch.dict(os.environ, environment):
+                lambda_handler.handler(event, None)
+            lines = emf_lines(capsys.readouterr().out)
+            assert len(lines) == expected_lines
+            for line in lines:
+                assert not any(name.endswith("Duration") for name in line)
+
+
+def lambda_handler_import_microseconds():
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import lambda_handler"],
+        cwd=src, capture_output=True, text=True, check=True
+    ).stderr
+    line = [line for line in output.splitlines() if line.endswith("| lambda_handler")][0]
+    return int(line.split("|")[1])
+
+
+def test_import_time_is_within_budget():
+    budget_ms = int(os.environ.get("IMPORT_TIME_BUDGET_MS", 150))
+    fastest = min(lambda_handler_import_microseconds() for _ in range(3))
+    assert fastest / 1000 < budget_ms
+
+
+def test_heavy_dependencies_are_not_imported_at_module_load():
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    output = subprocess.run(
+        [sys.executable, "-c", "import json, sys, lambda_handler; print(json.dumps(sorted(sys.modules)))"],
+        cwd=src, capture_output=True, text=True, check=True
+    ).stdout
+    loaded = set(json.loads(output))
+    assert not loaded & {"boto3", "botocore", "requests", "sgqlc", "sgqlc.types", "urllib.request"}
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_retried_invocation_returns_existing_results(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    event = {'consignmentId': consignment_id}
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+        first = lambda_handler.handler(event, None)
+        configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+        with patch('src.lambda_handler.write_results_json') as mock_write:
+            second = lambda_handler.handler(event, None)
+            mock_write.assert_not_called()
+    assert second == first
+    assert len(s3.list_objects(Bucket='test-backend-checks-bucket')['Contents']) == 1
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_results_are_rebuilt_when_api_response_changes(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    event = {'consignmentId': consignment_id}
+    changed_response = graphql_ok_multiple_files.replace(b"subfolder1.txt", b"renamed.txt")
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+        first = lambda_handler.handler(event, None)
+        configure_mock_urlopen(mock_url_open, changed_response)
+        second = lambda_handler.handler(event, None)
+    assert second["key"] != first["key"]
+    assert len(s3.list_objects(Bucket='test-backend-checks-bucket')['Contents']) == 2
+
+
+@pytest.mark.parametrize("code", ["404", "403"])
+def test_missing_results_are_not_found(s3, code):
+    from botocore.exceptions import ClientError
+    setup_env_vars()
+    error = ClientError({"Error": {"Code": code, "Message": "Error"}}, "HeadObject")
+    with patch.object(lambda_handler.clients.client("s3"), 'head_object', side_effect=error):
+        assert lambda_handler.find_existing_results(consignment_id, "fingerprint") is None
+
+
+def test_fingerprint_does_not_depend_on_order():
+    consignment = json.loads(graphql_ok_multiple_files)["data"]["getConsignment"]
+    reordered = consignment | {"files": list(reversed(consignment["files"]))}
+    assert lambda_handler.fingerprint_results("test-bucket", "prefix", consignment, all_file_ids) == \
+        lambda_handler.fingerprint_results("test-bucket", "prefix", reordered, list(reversed(all_file_ids)))
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_compact_results_expand_to_the_original_format(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    override_bucket = 'override-bucket'
+    override_key_prefix = 'sharepoint/prefix'
+    setup_s3(s3, bucket=override_bucket, prefix=f'{override_key_prefix}/')
+    event = {
+        'consignmentId': consignment_id,
+        "s3SourceBucket": override_bucket,
+        "s3SourceBucketPrefix": override_key_prefix
+    }
+    documents = {}
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        for results_format in ["json", "compact"]:
+            configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+            with patch.dict(os.environ, {"RESULTS_FORMAT": results_format}):
+                bucket_info = lambda_handler.handler(event, None)
+            body = s3.get_object(Bucket=bucket_info["bucket"], Key=bucket_info["key"])['Body'].read()
+            documents[results_format] = body
+    compact = json.loads(documents["compact"])
+    assert compact["version"] == 2
+    assert compact["header"]["s3SourceBucketKeyPrefix"] == override_key_prefix
+    assert compact["results"][0] == [
+        file_two_id, file_two_match_id, "testfile/subfolder/subfolder1.txt", "12", "achecksum"
+    ]
+    assert len(documents["compact"]) < len(documents["json"])
+    assert json.dumps(lambda_handler.expand_results(compact)).encode("utf-8") == documents["json"]
+
+
+def test_expand_results_returns_original_format_unchanged():
+    document = {"results": [], "statuses": {"statuses": []}}
+    assert lambda_handler.expand_results(document) is document
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_batch_returns_a_result_or_error_for_each_consignment(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    unknown_consignment_id = "00000000-0000-0000-0000-000000000000"
+
+    def graphql_response(request, timeout=None):
+        if unknown_consignment_id.encode("utf-8") in request.data:
+            raise urllib.error.HTTPError('http://testserver.com', 500, 'Some Error', {}, io.BytesIO(b''))
+        response = io.BytesIO(graphql_ok_multiple_files)
+        response.headers = {'Content-Type': 'application/json'}
+        return response
+
+    mock_url_open.side_effect = graphql_response
+    event = {'consignmentIds': [consignment_id, unknown_consignment_id]}
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = expiring_access_token(300)
+        response = lambda_handler.handler(event, None)
+        assert mock_post.call_count == 1
+    [success, failure] = response["consignments"]
+    assert success["consignmentId"] == consignment_id
+    assert success["key"].startswith(f"{consignment_id}/")
+    assert success["bucket"] == "test-backend-checks-bucket"
+    assert failure["consignmentId"] == unknown_consignment_id
+    assert failure["error"]["type"] == "Exception"
+    assert "HTTP Error 500" in failure["error"]["message"]
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_batch_entries_can_override_the_shared_fields(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    sharepoint_consignment_id = str(uuid.uuid4())
+    for match_id in all_match_ids:
+        s3.put_object(Body=b'filetoupload', Bucket="test-bucket", Key=f"sharepoint/prefix/{match_id}")
+
+    def graphql_response(request, timeout=None):
+        response = io.BytesIO(graphql_ok_multiple_files)
+        response.headers = {'Content-Type': 'application/json'}
+        return response
+
+    mock_url_open.side_effect = graphql_response
+    event = {
+        's3SourceBucket': 'test-bucket',
+        'consignmentIds': [
+            consignment_id,
+            {'consignmentId': sharepoint_consignment_id, 's3SourceBucketPrefix': 'sharepoint/prefix'},
+            {'s3SourceBucketPrefix': 'sharepoint/prefix'}
+        ]
+    }
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        response = lambda_handler.handler(event, None)
+    [default, sharepoint, missing_id] = response["consignments"]
+    assert default["key"].startswith(f"{consignment_id}/")
+    assert sharepoint["key"].startswith(f"{sharepoint_consignment_id}/")
+    results = get_result_from_s3(s3, sharepoint_consignment_id)["results"]
+    assert sorted(result["s3SourceBucketKey"] for result in results) == \
+        sorted(f"sharepoint/prefix/{match_id}" for match_id in all_match_ids)
+    assert missing_id["error"] == {"type": "ValueError", "message": "Batch entry has no consignmentId"}
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_error_if_uploaded_file_size_does_not_match_api(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    s3.put_object(Body=b'file', Bucket="test-bucket", Key=f"{user_id}/{consignment_id}/{file_one_id}")
+    event = {'consignmentId': consignment_id}
+    configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        with pytest.raises(lambda_handler.UploadMismatchError) as ex:
+            lambda_handler.handler(event, None)
+    assert ex.value.args[0] == f'Uploaded files do not match files from the API for {user_id}/{consignment_id}'
+    assert ex.value.args[1]["missingCount"] == 0
+    assert ex.value.args[1]["sizeMismatchCount"] == 1
+    assert ex.value.args[1]["sizeMismatchSample"] == [{"identifier": file_one_id, "expectedSize": 12, "listedSize": 4}]
+
+
+@patch.dict(os.environ, {"VERIFY_FILE_SIZES": "false"})
+def test_file_sizes_are_not_checked_when_verification_is_off():
+    consignment = json.loads(graphql_ok_multiple_files)["data"]["getConsignment"]
+    report = lambda_handler.validate_all_files_uploaded(
+        "test-bucket", "prefix", consignment, {file_one_id: 1, file_two_id: 2}
+    )
+    assert report.matched
+
+
+def sent_queries(mock_url_open):
+    return [json.loads(call.args[0].data)["query"] for call in mock_url_open.call_args_list]
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_projected_query_is_sent_by_default(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        lambda_handler.handler({'consignmentId': consignment_id}, None)
+    [query] = sent_queries(mock_url_open)
+    assert 'fileFiltersInput: {fileTypeIdentifier: "File"' in query
+    assert '"ClientSideOriginalFilepath", "ClientSideFileSize", "SHA256ClientSideChecksum"' in query
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_full_query_is_used_when_projected_query_is_rejected(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    rejection = b'{"errors": [{"message": "Unknown argument \'fileFiltersInput\'"}]}'
+
+    def responses():
+        yield urllib.error.HTTPError('http://testserver.com', 400, 'Bad Request', {}, io.BytesIO(rejection))
+        while True:
+            response = io.BytesIO(graphql_ok_multiple_files)
+            response.headers = {'Content-Type': 'application/json'}
+            yield response
+
+    mock_url_open.side_effect = responses()
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        lambda_handler.handler({'consignmentId': consignment_id}, None)
+        lambda_handler.handler({'consignmentId': consignment_id}, None)
+    queries = sent_queries(mock_url_open)
+    assert len(queries) == 3
+    assert "fileFiltersInput" in queries[0]
+    assert "fileFiltersInput" not in queries[1]
+    assert "fileFiltersInput" not in queries[2]
+
+
+@pytest.mark.parametrize("error", [
+    {"data": None, "errors": [{"message": "Consignment not found"}]},
+    json_http_error(401, {"errors": [{"message": "Unauthorized"}]})
+])
+@patch('src.lambda_handler.session_urlopen')
+def test_projection_is_kept_after_other_api_errors(mock_url_open, ssm, error):
+    setup_env_vars()
+    setup_ssm(ssm)
+    payload = error if isinstance(error, Exception) else json.dumps(error).encode("utf-8")
+    configure_mock_urlopen(mock_url_open, payload)
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        with pytest.raises(Exception):
+            lambda_handler.handler({'consignmentId': consignment_id}, None)
+    assert not lambda_handler.clients.projected_query_rejected
+    assert all("fileFiltersInput" in query for query in sent_queries(mock_url_open))
+
+
+@patch.dict(os.environ, {"PROJECTED_QUERY": "false"})
+@patch('src.lambda_handler.session_urlopen')
+def test_full_query_is_sent_when_projection_is_off(mock_url_open, ssm, s3):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+    configure_mock_urlopen(mock_url_open, graphql_ok_multiple_files)
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        lambda_handler.handler({'consignmentId': consignment_id}, None)
+    [query] = sent_queries(mock_url_open)
+    assert "fileFiltersInput" not in query
+
+
+def test_api_rate_limiter_spaces_requests():
+    limiter = lambda_handler.ApiRateLimiter()
+    with patch.dict(os.environ, {"API_REQUESTS_PER_SECOND": "4"}), patch('time.sleep') as mock_sleep:
+        for _ in range(3):
+            limiter.wait()
+    delays = [call.args[0] for call in mock_sleep.call_args_list]
+    assert len(delays) == 2
+    assert 0.2 < delays[0] <= 0.25
+    assert 0.45 < delays[1] <= 0.5
+
+
+def test_reprocess_reads_consignment_ids_and_events(capsys):
+    lines = [f"{consignment_id}\n", "\n", json.dumps({"consignmentId": "other", "s3SourceBucket": "bucket"}),
+             json.dumps({"s3SourceBucket": "bucket"}), "{not json"]
+    assert list(reprocess.read_events(lines)) == [
+        {"consignmentId": consignment_id},
+        {"consignmentId": "other", "s3SourceBucket": "bucket"}
+    ]
+    errors = capsys.readouterr().err
+    assert "Skipping line 4, which has no consignmentId" in errors
+    assert "Skipping line 5, which is not valid JSON" in errors
+
+
+@patch('src.lambda_handler.session_urlopen')
+def test_reprocess_records_results_and_resumes(mock_url_open, ssm, s3, tmp_path, capsys):
+    setup_env_vars()
+    setup_ssm(ssm)
+    setup_s3(s3)
+
+    def ok_response(*args, **kwargs):
+        response = io.BytesIO(graphql_ok_multiple_files)
+        response.headers = {'Content-Type': 'application/json'}
+        return response
+
+    mock_url_open.side_effect = ok_response
+    missing_consignment_id = str(uuid.uuid4())
+    events = [{"consignmentId": consignment_id}, {"consignmentId": missing_consignment_id}]
+    summary_path = tmp_path / "summary.jsonl"
+    with patch('requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json = access_token
+        first = reprocess.reprocess(events, summary_path)
+        calls = mock_url_open.call_count
+        second = reprocess.reprocess(events, summary_path)
+
+    assert (first["succeeded"], first["failed"], first["skipped"]) == (1, 1, 0)
+    assert (second["succeeded"], second["failed"], second["skipped"]) == (0, 1, 1)
+    assert mock_url_open.call_count == calls * 3 // 2
+    entries = [json.loads(line) for line in summary_path.read_text().splitlines()]
+    assert [entry["consignmentId"] for entry in entries] == \
+        [consignment_id, missing_consignment_id, missing_consignment_id]
+    assert entries[0]["key"].startswith(f"{consignment_id}/")
+    assert entries[1]["error"]["type"] == "UploadMismatchError"
+    output = capsys.readouterr()
+    assert "2/2 finished, 1 failed" in output.err
+    assert '"_aws"' not in output.out
+    assert "METRICS_LEVEL" not in os.environ
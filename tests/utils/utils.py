@@ -2,6 +2,8 @@ import os
 import io
 import json
 
+from src import lambda_handler
+
 user_id = '030cf12c-8d5d-46b9-b86a-38e0920d0e1a'
 consignment_id = 'e7073993-0bed-4d5f-bb2a-5bea1b2a87d3'
 file_one_id = "13702546-da63-4545-a9eb-a892df1aafba"
@@ -34,7 +36,7 @@ graphql_ok_multiple_files = b'''{
             },
             {
               "name": "ClientSideFileSize",
-              "value": "0"
+              "value": "12"
             }
           ]
         },
@@ -53,7 +55,7 @@ graphql_ok_multiple_files = b'''{
             },
             {
               "name": "ClientSideFileSize",
-              "value": "0"
+              "value": "12"
             }
           ]
         }
@@ -64,6 +66,85 @@ graphql_ok_multiple_files = b'''{
 '''
 
 
+graphql_ok_paginated_page_one = b'''{
+  "data": {
+    "getConsignment": {
+      "consignmentType": "standard",
+      "userid": "030cf12c-8d5d-46b9-b86a-38e0920d0e1a",
+      "paginatedFiles": {
+        "pageInfo": {
+          "hasNextPage": true,
+          "endCursor": "1c2b9eeb-2e4c-4cfc-bc08-c193660f86d2"
+        },
+        "edges": [
+          {
+            "node": {
+              "fileId": "1c2b9eeb-2e4c-4cfc-bc08-c193660f86d2",
+              "uploadMatchId": "matchId2",
+              "fileType": "File",
+              "fileMetadata": [
+                {
+                  "name": "ClientSideOriginalFilepath",
+                  "value": "testfile/subfolder/subfolder1.txt"
+                },
+                {
+                  "name": "SHA256ClientSideChecksum",
+                  "value": "achecksum"
+                },
+                {
+                  "name": "ClientSideFileSize",
+                  "value": "12"
+                }
+              ]
+            }
+          }
+        ]
+      }
+    }
+  }
+}
+'''
+
+graphql_ok_paginated_page_two = b'''{
+  "data": {
+    "getConsignment": {
+      "consignmentType": "standard",
+      "userid": "030cf12c-8d5d-46b9-b86a-38e0920d0e1a",
+      "paginatedFiles": {
+        "pageInfo": {
+          "hasNextPage": false,
+          "endCursor": "13702546-da63-4545-a9eb-a892df1aafba"
+        },
+        "edges": [
+          {
+            "node": {
+              "fileId": "13702546-da63-4545-a9eb-a892df1aafba",
+              "uploadMatchId": "matchId1",
+              "fileType": "File",
+              "fileMetadata": [
+                {
+                  "name": "ClientSideOriginalFilepath",
+                  "value": "testfile/subfolder/subfolder2.txt"
+                },
+                {
+                  "name": "SHA256ClientSideChecksum",
+                  "value": "achecksum"
+                },
+                {
+                  "name": "ClientSideFileSize",
+                  "value": "12"
+                }
+              ]
+            }
+          }
+        ]
+      }
+    }
+  }
+}
+'''
+
+
 def setup_ssm(ssm):
     ssm.put_parameter(
         Name="/test/client/secret",
@@ -77,8 +158,7 @@ def setup_ssm(ssm):
 def get_result_from_s3(s3, prefix):
     bucket = 'test-backend-checks-bucket'
     objects = s3.list_objects(Bucket=bucket, Prefix=prefix + "/")
-    obj = s3.get_object(Bucket='test-backend-checks-bucket', Key=objects['Contents'][0]['Key'])
-    return json.loads(obj['Body'].read().decode("utf-8"))
+    return lambda_handler.read_results(bucket, objects['Contents'][0]['Key'], s3)
 
 
 def _override_object_identifier(prefix: str):
@@ -123,6 +203,41 @@ def configure_mock_urlopen(mock_urlopen, payload):
         mock_urlopen.return_value = mock_response
 
 
+def configure_mock_urlopen_pages(mock_urlopen, payloads):
+    responses = []
+    for payload in payloads:
+        if isinstance(payload, Exception):
+            responses.append(payload)
+            continue
+        mock_response = io.BytesIO(payload)
+        mock_response.headers = {'Content-Type': 'application/json'}
+        responses.append(mock_response)
+    mock_urlopen.side_effect = responses
+
+
+class DiscardingS3:
+    """An S3 client for the results writers that keeps only the size of each upload."""
+
+    def __init__(self):
+        self.uploaded_bytes = []
+
+    def put_object(self, Body, **kwargs):
+        self.uploaded_bytes.append(len(Body))
+
+    def create_multipart_upload(self, **kwargs):
+        return {"UploadId": "upload"}
+
+    def upload_part(self, Body, **kwargs):
+        self.uploaded_bytes.append(len(Body))
+        return {"ETag": "etag"}
+
+    def complete_multipart_upload(self, **kwargs):
+        pass
+
+    def abort_multipart_upload(self, **kwargs):
+        pass
+
+
 def access_token():
     return {'access_token': 'ABCD'}
 
@@ -135,6 +250,7 @@ def setup_env_vars():
     os.environ["BUCKET_NAME"] = "test-bucket"
     os.environ['AWS_DEFAULT_REGION'] = 'eu-west-2'
     os.environ['BACKEND_CHECKS_BUCKET_NAME'] = "test-backend-checks-bucket"
+    os.environ['HTTP_BACKOFF_BASE_SECONDS'] = "0"
 
 
 def sort_by_id(file):